@@ -0,0 +1,151 @@
+"""
+Pixel classification by colour through a lookup table.
+
+The table has an entry for every 24 bit BGR colour (16 MB), holding whether
+that colour is foreground. It is built by converting all 2**24 colours to
+HSV or Lab once and classifying them either by channel ranges, exactly as
+cv2.inRange would on the converted image, or by their distance to sampled
+colours. Segmenting an image is then a single table lookup per pixel,
+whatever the colour space or the number of samples.
+
+On a 48 MP image the lookup takes about 0.2 s, against 0.13 s for
+cvtColor + inRange and 0.05 s for a grey threshold, so it is not as fast as
+grey thresholding, but it costs the same for sample sets that inRange
+cannot express. Building a table takes about 0.2 s for ranges and 0.5 s
+with samples, once per settings change.
+"""
+import cv2
+import numpy as np
+
+# The table covers every 24 bit colour
+LUT_SIZE = 2**24
+
+# Colours converted and classified at a time while building a table
+BUILD_ROWS = 256
+
+# Rows of an image looked up at a time, small enough for the index buffers
+# to stay in cache
+LUT_STRIP_ROWS = 64
+
+HSV = cv2.COLOR_BGR2HSV
+LAB = cv2.COLOR_BGR2Lab
+
+
+def color_block(start, rows):
+    """
+    Returns the BGR colours with table indices start to start + rows*4096 as
+    a (rows, 4096, 3) image, index b | g << 8 | r << 16 being colour (b, g, r).
+    """
+    index = np.arange(start, start + rows*4096, dtype=np.uint32).reshape(rows, 4096)
+    block = np.empty((rows, 4096, 3), dtype=np.uint8)
+    block[..., 0] = index & 255
+    block[..., 1] = (index >> 8) & 255
+    block[..., 2] = index >> 16
+    return block
+
+
+def convert(colors, code):
+    """
+    Converts an (n, 3) array of BGR colours with a cvtColor code.
+    """
+    colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 1, 3)
+    return cv2.cvtColor(colors, code).reshape(-1, 3).astype(np.float32)
+
+
+def color_distances(colors, samples, code):
+    """
+    The distance from each colour to its closest sample in the colour space
+    of code, both given in that space. HSV colours are compared in the HSV
+    cone, where hue counts in proportion to saturation, so that the unstable
+    hue of greyish colours does not dominate.
+    """
+    if len(samples) == 0:
+        return np.full(len(colors), np.inf)
+
+    if code == HSV:
+        colors, samples = hsv_cone(colors), hsv_cone(samples)
+
+    # Squared distances, accumulated channel by channel in place
+    closest = np.full(len(colors), np.inf, dtype=np.float32)
+    squared = np.empty_like(closest)
+    diff = np.empty_like(closest)
+    for sample in samples:
+        squared[:] = 0
+        for c in range(3):
+            np.subtract(colors[:, c], sample[c], out=diff)
+            diff *= diff
+            squared += diff
+        np.minimum(closest, squared, out=closest)
+    return np.sqrt(closest, out=closest)
+
+
+def hsv_cone(colors):
+    """
+    Maps 8 bit HSV colours, hue running from 0 to 179, to cartesian
+    coordinates in the HSV cone.
+    """
+    angle = colors[:, 0]*np.float32(np.pi/90.0)
+    return np.stack([colors[:, 1]*np.cos(angle), colors[:, 1]*np.sin(angle), colors[:, 2]], axis=1)
+
+
+def in_ranges(converted, code, lower, upper):
+    """
+    The inRange mask of a converted image; in HSV a hue range with
+    lower > upper wraps around red.
+    """
+    if code == HSV and lower[0] > upper[0]:
+        low = cv2.inRange(converted, (lower[0], lower[1], lower[2]), (255, upper[1], upper[2]))
+        high = cv2.inRange(converted, (0, lower[1], lower[2]), (upper[0], upper[1], upper[2]))
+        return cv2.bitwise_or(low, high)
+    return cv2.inRange(converted, tuple(lower), tuple(upper))
+
+
+def build_lut(code, lower, upper, samples=(), tolerance=0):
+    """
+    Builds the table for a colour space. With samples, colours within
+    tolerance of a sampled colour are foreground. Otherwise colours with every
+    channel in [lower, upper] are.
+    """
+    lut = np.empty(LUT_SIZE, dtype=np.uint8)
+    reference = convert(samples, code) if len(samples) > 0 else None
+    step = BUILD_ROWS*4096
+
+    for start in range(0, LUT_SIZE, step):
+        converted = cv2.cvtColor(color_block(start, BUILD_ROWS), code)
+        if reference is None:
+            lut[start:start + step] = in_ranges(converted, code, lower, upper).ravel()
+        else:
+            inside = color_distances(converted.reshape(-1, 3).astype(np.float32), reference, code) <= tolerance
+            lut[start:start + step] = np.where(inside, 255, 0)
+
+    return lut
+
+
+def apply_lut(image, lut):
+    """
+    Looks up every pixel of a BGR image in a table from build_lut and returns
+    the binary image.
+    """
+    height, width = image.shape[:2]
+    binary = np.empty((height, width), dtype=np.uint8)
+
+    # Each pixel padded with a zero byte reads as its little endian uint32 index
+    quads = np.zeros((LUT_STRIP_ROWS, width, 4), dtype=np.uint8)
+    for y in range(0, height, LUT_STRIP_ROWS):
+        strip = image[y:y + LUT_STRIP_ROWS]
+        n = len(strip)
+        q = quads[:n]
+        cv2.mixChannels([strip], [q], [0, 0, 1, 1, 2, 2])
+        np.take(lut, q.view(np.uint32)[..., 0], out=binary[y:y + n])
+
+    return binary
+
+
+def sample_color(image, x, y, radius=2):
+    """
+    The mean BGR colour of the (2*radius + 1) square patch around (x, y).
+    """
+    height, width = image.shape[:2]
+    x, y = int(round(x)), int(round(y))
+    patch = image[max(0, y - radius):min(height, y + radius + 1), max(0, x - radius):min(width, x + radius + 1)]
+    return tuple(int(round(v)) for v in patch.reshape(-1, 3).mean(axis=0))
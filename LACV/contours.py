@@ -0,0 +1,176 @@
+import cv2
+import numpy as np
+
+
+class ContourStore:
+    """
+    A packed set of grain contours.
+
+    All contour points live in one flat (n, 2) int32 buffer and contour k is
+    points[offsets[k]:offsets[k + 1]]. Outer contours come first, in label
+    order, so that store[i] is the boundary of label i + 1; holes follow and
+    parents[k] gives the outer contour a hole belongs to (-1 for outer ones).
+
+    The store pickles as its four arrays, so with pickle protocol 5 it can be
+    sent to caches and worker processes as out-of-band buffers without copying.
+    """
+
+    def __init__(self, points, offsets, parents):
+        self.points = np.ascontiguousarray(points, dtype=np.int32).reshape(-1, 2)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        self.parents = np.ascontiguousarray(parents, dtype=np.int32)
+        self.n_outer = int((self.parents < 0).sum())
+        self._simplified = {}
+
+    @classmethod
+    def find(cls, mask, labels=None):
+        """
+        Finds the outer contours and holes of a binary mask. If a label image is
+        given, outer contours are ordered by the label they enclose.
+        """
+        contours, hierarchy = cv2.findContours(mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            return cls(np.zeros((0, 2)), np.zeros(1), np.zeros(0))
+
+        parents = hierarchy[0][:, 3]
+        outer = np.nonzero(parents < 0)[0]
+        holes = np.nonzero(parents >= 0)[0]
+
+        if labels is not None:
+            first = np.array([contours[i][0, 0] for i in outer])
+            outer = outer[np.argsort(labels[first[:, 1], first[:, 0]], kind='stable')]
+
+        order = np.concatenate([outer, holes])
+        renumber = np.empty(len(contours), dtype=np.int32)
+        renumber[order] = np.arange(len(order))
+        new_parents = np.where(parents[order] < 0, -1, renumber[np.maximum(parents[order], 0)])
+
+        counts = [len(contours[i]) for i in order]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        points = np.concatenate([contours[i].reshape(-1, 2) for i in order])
+
+        return cls(points, offsets, new_parents)
+
+    @classmethod
+    def concatenate(cls, stores, shifts=None):
+        """
+        Joins several stores into one, shifting the points of store i by
+        shifts[i] = (dx, dy). Outer contours keep their order, store by store.
+        """
+        if shifts is None:
+            shifts = [(0, 0)]*len(stores)
+
+        outer, holes, parents = [], [], []
+        outer_counts, hole_counts = [], []
+        n = 0
+        for store, shift in zip(stores, shifts):
+            split = store.offsets[store.n_outer]
+            points = store.points + np.asarray(shift, dtype=np.int32)
+            counts = np.diff(store.offsets)
+            outer.append(points[:split])
+            holes.append(points[split:])
+            outer_counts.append(counts[:store.n_outer])
+            hole_counts.append(counts[store.n_outer:])
+            parents.append(store.parents[store.n_outer:] + n)
+            n += store.n_outer
+
+        counts = np.concatenate([np.zeros(0, dtype=np.int64)] + outer_counts + hole_counts)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        points = np.concatenate([np.zeros((0, 2), dtype=np.int32)] + outer + holes)
+        parents = np.concatenate([np.full(n, -1, dtype=np.int32)] + parents)
+
+        return cls(points, offsets, parents)
+
+    def __reduce__(self):
+        return (type(self), (self.points, self.offsets, self.parents))
+
+    def __len__(self):
+        return self.n_outer
+
+    def __getitem__(self, i):
+        """
+        Returns outer contour i as an OpenCV style (k, 1, 2) view into the buffer.
+        """
+        if i < 0:
+            i += self.n_outer
+        if not 0 <= i < self.n_outer:
+            raise IndexError('contour index out of range')
+        return self.contour(i)
+
+    def __iter__(self):
+        for i in range(self.n_outer):
+            yield self.contour(i)
+
+    def contour(self, k):
+        return self.points[self.offsets[k]:self.offsets[k + 1]].reshape(-1, 1, 2)
+
+    def holes(self, i):
+        """
+        Returns the hole contours of outer contour i.
+        """
+        return [self.contour(k) for k in np.nonzero(self.parents == i)[0]]
+
+    def all_contours(self):
+        """
+        Returns every contour, outer ones first, as a list for cv2.drawContours.
+        """
+        return [self.contour(k) for k in range(len(self.parents))]
+
+    def simplified(self, tolerance):
+        """
+        Returns a Douglas-Peucker simplified copy, with tolerance in pixels.
+        Results are kept, so asking again for the same tolerance is free.
+        """
+        if tolerance <= 0:
+            return self
+
+        if tolerance not in self._simplified:
+            simple = [cv2.approxPolyDP(self.contour(k), tolerance, True).reshape(-1, 2)
+                      for k in range(len(self.parents))]
+            counts = [len(c) for c in simple]
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            points = np.concatenate(simple) if simple else np.zeros((0, 2))
+            self._simplified[tolerance] = ContourStore(points, offsets, self.parents)
+
+        return self._simplified[tolerance]
+
+    def select(self, outer):
+        """
+        Returns a store with only the given outer contours, in the given order,
+        and their holes.
+        """
+        outer = np.asarray(outer, dtype=np.intp)
+        renumber = np.full(self.n_outer, -1, dtype=np.int32)
+        renumber[outer] = np.arange(len(outer))
+
+        hole_parents = self.parents[self.n_outer:]
+        holes = self.n_outer + np.nonzero(renumber[hole_parents] >= 0)[0]
+        keep = np.concatenate([outer, holes]).astype(np.intp)
+        parents = np.concatenate([np.full(len(outer), -1), renumber[self.parents[holes]]])
+
+        starts = self.offsets[keep]
+        counts = self.offsets[keep + 1] - starts
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        index = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+
+        return ContourStore(self.points[index], offsets, parents)
+
+    def perimeters(self):
+        """
+        Returns the closed arc length of every outer contour.
+        """
+        outer_end = self.offsets[self.n_outer]
+        points = self.points[:outer_end].astype(np.float64)
+        if len(points) == 0:
+            return np.zeros(self.n_outer)
+
+        starts = self.offsets[:self.n_outer]
+        # Step to the next point, wrapping the last point of each contour to its first
+        following = np.arange(1, outer_end + 1)
+        following[self.offsets[1:self.n_outer + 1] - 1] = starts
+        steps = np.sqrt(((points[following] - points)**2).sum(axis=1))
+
+        return np.add.reduceat(steps, starts)
+
+    def nbytes(self):
+        return self.points.nbytes + self.offsets.nbytes + self.parents.nbytes
@@ -1,25 +1,53 @@
 import os
 import cv2
-import xml.etree.ElementTree as ET
-from math import cos, sin, radians
 import numpy as np
 
-from .finders import ThresholdFinder, AdaptiveThresholdFinder, OtsuThresholdFinder
-from .targeters import CoreTargeter, RimTargeter, MomentsTargeter, SimpleBlobTargeter
 from .generators import ChromiumGenerator, GeoStarGenerator
+from .sequencing import order_spots
+from .pipeline import find_source_pair, pair_sources, read_align, align_transform, image_to_stage, \
+    make_recipe, save_recipe, FINDERS, TARGETERS
+from .watch import SourceWatcher, RECIPE_FILE
+from .server import JobServer, DEFAULT_PORT
+from .roi import ROI
+from .prefetch import Prefetcher
 
 from PyQt5.QtGui import QTransform, QPolygonF
 from PyQt5.QtCore import QPointF
 
 class LACVController:
     
-    finders = [ThresholdFinder, AdaptiveThresholdFinder, OtsuThresholdFinder]
-    targeters = [CoreTargeter, RimTargeter, MomentsTargeter, SimpleBlobTargeter]
+    finders = FINDERS
+    targeters = TARGETERS
     generators = [ChromiumGenerator, GeoStarGenerator]
 
     finder = None
     targeter = None
     generator = None
+    sequence = []
+    watcher = None
+    server = None
+
+    # The mounts of the session directory in file order, the index of the
+    # current one, and the Prefetcher decoding the ones around it
+    session = []
+    session_index = -1
+    prefetcher = None
+    # Mounts decoded ahead of the current one, and the memory all decoded
+    # mounts may take in bytes (None for the Prefetcher default)
+    prefetch_ahead = 2
+    prefetch_budget = None
+
+    # User drawn ROI polygons in image coordinates, and whether to also mask
+    # out the empty parts of the mount automatically
+    roi_polygons = []
+    auto_roi = False
+    _roi = None
+    _source_image = None
+
+    # Stage speed used to estimate travel time, in stage units (microns) per second
+    stage_speed = 1000.0
+    # Time allowed for refining the spot order, in seconds
+    sequence_time_budget = 2.0
 
     global_finder_settings = {
         'area': {
@@ -51,82 +79,139 @@ class LACVController:
 
         print('source=%s' % source)
 
-        # Find complement
-        source_dir = os.path.dirname(source)
-        image_file = ""
-        align_file = ""
-        print('source_dir=%s' % source_dir)
-
-        if source.lower().endswith(".align"):
-            print("given an align file")
-            align_file = os.path.basename(source)
-            file_root = align_file.split(".")[0]
-
-            for file in os.listdir(source_dir):
-                print(file)
-                if file == align_file:
-                    continue
-                elif file.startswith(file_root) and file.split(".")[1] in ['bmp', 'jpg', 'png', 'tiff']:
-                    image_file = file
-                    break
-        else:
-            print("given an image file")
-            image_file = os.path.basename(source)
-            file_root = image_file.split(".")[0]
-
-            for file in os.listdir(source_dir):
-                print(file)
-                if file == image_file:
-                    continue
-                elif file.startswith(file_root) and file.split(".")[1].lower() == "align":
-                    align_file = file
-                    break
-
-
-        print('align file=%s'%align_file)
-        print('image file=%s'%image_file)
-
-        if not align_file or not image_file:
+        image_path, align_path = find_source_pair(source)
+        print('align file=%s'%align_path)
+        print('image file=%s'%image_path)
+
+        if not align_path or not image_path:
             print('Could not find the image/align pair... abort!')
             self._source_image = None
             return
 
-        print('loading image file:%s'%os.path.join(source_dir, image_file))
-        self._source_image = cv2.imread(os.path.join(source_dir, image_file))
-        #self._source_image = noisy('gauss', self._source_image).astype(np.uint8)
+        print('loading image file:%s'%image_path)
+        image = cv2.imread(image_path)
+        #image = noisy('gauss', image).astype(np.uint8)
+
+        print('processing align file:%s'%align_path)
+        self._set_mount(image, read_align(align_path))
 
-        print('processing align file:%s'%os.path.join(source_dir, align_file))
-        align_xml = ET.parse(os.path.join(source_dir, align_file))
-        align_root = align_xml.getroot()
-        align = align_root.find('Alignment')
-        self.align_rotation = float(align.find('Rotation').text)
-        self.align_center = [float(x) for x in align.find('Center').text.split(',')]
-        self.align_size = [float(x) for x in align.find('Size').text.split(',')]
+    def _set_mount(self, image, align):
+        self._source_image = image
+        self.align_rotation = align['rotation']
+        self.align_center = align['center']
+        self.align_size = align['size']
 
         print('microns per pixel = %f'%(self.microns_per_pixel()))
 
-        xc, yc = self.align_center[0], self.align_center[1]
-        xmin, ymin = xc - self.align_size[0]/2.0, yc - self.align_size[1]/2.0
-        xmax, ymax = xc + self.align_size[0]/2.0, yc + self.align_size[1]/2.0
-        r = -self.align_rotation
-
-        def rot(x, y):
-            xp = xc + (x - xc)*cos(radians(r)) - (y-yc)*sin(radians(r))
-            yp = yc + (x - xc)*sin(radians(r)) - (y-yc)*cos(radians(r))
-            return xp, yp
-        
-        src = np.float32([ 
-            [0, 0],
-            [0, self._source_image.shape[0]],
-            [self._source_image.shape[1], self._source_image.shape[0]]
-        ])
-        dst = np.float32([
-            rot(xmin, ymin),
-            rot(xmin, ymax),
-            rot(xmax, ymax)
-        ])
-        self.transform = cv2.getAffineTransform(src, dst)
+        self.transform = align_transform(self._source_image.shape, align)
+
+        self.roi_polygons = []
+        self._roi = None
+
+    def open_session(self, source):
+        """
+        Opens a mount and makes the image/align pairs of its directory the
+        session, in file order, so that step_mount can move through them while
+        the next ones are decoded in the background. Returns the Mount, or None
+        if it could not be loaded.
+        """
+        directory = os.path.dirname(source)
+        pairs = [pair for _, pair in sorted(pair_sources(os.listdir(directory or '.')).items())]
+        names = [os.path.basename(source) in pair for pair in pairs]
+        if not any(names):
+            print('Could not find the image/align pair... abort!')
+            return None
+
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        self.session = [os.path.join(directory, align_file) for _, align_file in pairs]
+        self.prefetcher = Prefetcher(self.session, ahead=self.prefetch_ahead, budget=self.prefetch_budget)
+
+        return self.go_to_mount(names.index(True))
+
+    def step_mount(self, offset):
+        """
+        Moves offset mounts along the session. Returns the Mount, or None at
+        either end of the session or if it could not be loaded.
+        """
+        index = self.session_index + offset
+        if self.prefetcher is None or not 0 <= index < len(self.session):
+            return None
+        return self.go_to_mount(index)
+
+    def go_to_mount(self, index):
+        """
+        Makes mount index of the session the source. If a finder is chosen,
+        the finder and targeter are replaced by ones run on the new mount with
+        the current recipe, usually already by the prefetcher.
+        """
+        self.prefetcher.set_recipe(self.recipe() if self.finder is not None else None)
+        mount = self.prefetcher.get(index)
+        if mount is None:
+            print('Could not load %s'%self.session[index])
+            return None
 
+        print('source=%s' % mount.source)
+        self.session_index = index
+        self._set_mount(mount.image, mount.align)
+        if mount.finder is not None:
+            self.finder = mount.finder
+            self.targeter = mount.targeter
+            self._roi = mount.finder.roi
+        return mount
+
+    def roi(self):
+        """
+        Returns the ROI of the source image, or None if it is processed whole.
+        """
+        if self._roi is None and self._source_image is not None:
+            self._roi = ROI.from_image(self._source_image, self.roi_polygons, self.auto_roi)
+        return self._roi
+
+    def set_roi(self, polygons=None, auto=None):
+        """
+        Changes the ROI polygons and/or automatic mount mask and passes the new
+        ROI on to the finder.
+        """
+        if polygons is not None:
+            self.roi_polygons = polygons
+        if auto is not None:
+            self.auto_roi = auto
+        self._roi = None
+
+        if self.finder is not None:
+            self.finder.set_roi(self.roi())
+            self.finder.changed.emit()
+
+    def recipe(self):
+        """
+        Returns the current finder/targeter recipe, see pipeline.make_recipe.
+        """
+        return make_recipe(self.finder, self.targeter)
+
+    def watch(self, directory, output_dir=None, workers=2):
+        """
+        Starts processing new mounts arriving in directory with the current
+        recipe in a background thread. Returns the SourceWatcher.
+        """
+        recipe = self.recipe()
+        save_recipe(os.path.join(directory, RECIPE_FILE), recipe)
+
+        self.watcher = SourceWatcher(directory, recipe, output_dir, workers)
+        self.watcher.start()
+        return self.watcher
+
+    def serve(self, output_dir, host='127.0.0.1', port=DEFAULT_PORT, workers=2, data_root='.'):
+        """
+        Starts a job server in a background thread so that scripts and other
+        machines can submit mounts within data_root, see LACV.server. Returns
+        the JobServer.
+        """
+        if self.server is not None:
+            self.server.stop()
+        self.server = JobServer(output_dir, host, port, data_root, workers=workers)
+        self.server.start()
+        return self.server
 
     def microns_per_pixel(self):
         return np.array( [self.align_size[0]/self._source_image.shape[1], self.align_size[1]/self._source_image.shape[0] ]).mean()
@@ -143,6 +228,27 @@ class LACVController:
         return cs[0]
 
 
+    def coords_in_image_to_stagespace(self, coords):
+        """
+        Maps an (n, 2) array of image coordinates to stage coordinates.
+        """
+        return image_to_stage(self.transform, coords)
+
+    def sequence_spots(self, coords):
+        """
+        Orders spots to minimize stage travel between them. Returns the
+        reordered coordinates and the estimated travel time saved in seconds.
+        """
+        if len(coords) == 0:
+            return [], 0.0
+
+        stage = self.coords_in_image_to_stagespace(coords)
+        order, before, after = order_spots(stage, self.sequence_time_budget)
+        saved = (before - after)/self.stage_speed
+
+        print('Stage travel %.0f -> %.0f, estimated time saved = %.1f s'%(before, after, saved))
+        return [coords[i] for i in order], saved
+
     def source_image(self):
         return self._source_image
 
@@ -0,0 +1,198 @@
+import os
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from .pipeline import run_mount, write_spots, spots_path, file_root
+
+CONTOUR_COLOR = (0, 200, 0)
+SPOT_COLOR = (0, 0, 255)
+TEXT_COLOR = (255, 255, 0)
+
+
+class Overlay:
+    """
+    The annotations of a mount (grain contours and numbered spots) with
+    per-contour bounding boxes, so that a tile only draws what it overlaps.
+    """
+
+    def __init__(self, contours, coords, spot_size):
+        self.contours = contours.all_contours() if hasattr(contours, 'all_contours') else list(contours)
+        if self.contours:
+            self.boxes = np.array([cv2.boundingRect(c) for c in self.contours])
+        else:
+            self.boxes = np.zeros((0, 4), dtype=int)
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.spot_size = spot_size
+
+    def draw(self, tile, x0, y0, scale):
+        """
+        Draws the overlay onto a tile whose top left corner is at (x0, y0) in
+        image pixels and that shows the image scaled by scale.
+        """
+        height, width = tile.shape[:2]
+        x1, y1 = x0 + width/scale, y0 + height/scale
+        thickness = max(1, int(round(4*scale)))
+        radius = self.spot_size/2.0
+
+        boxes = self.boxes
+        visible = np.nonzero((boxes[:, 0] < x1) & (boxes[:, 0] + boxes[:, 2] > x0) &
+                             (boxes[:, 1] < y1) & (boxes[:, 1] + boxes[:, 3] > y0))[0]
+        shifted = [np.round((self.contours[i] - (x0, y0))*scale).astype(np.int32) for i in visible]
+        cv2.polylines(tile, shifted, True, CONTOUR_COLOR, thickness, cv2.LINE_AA)
+
+        c = self.coords
+        visible = np.nonzero((c[:, 0] + radius > x0) & (c[:, 0] - radius < x1) &
+                             (c[:, 1] + radius > y0) & (c[:, 1] - radius < y1))[0]
+        font_scale = max(0.3, scale)
+        for i in visible:
+            center = (int(round((c[i, 0] - x0)*scale)), int(round((c[i, 1] - y0)*scale)))
+            cv2.circle(tile, center, max(1, int(round(radius*scale))), SPOT_COLOR, thickness, cv2.LINE_AA)
+            cv2.putText(tile, str(i + 1), (center[0] + int(radius*scale), center[1]),
+                        cv2.FONT_HERSHEY_SIMPLEX, font_scale, TEXT_COLOR, thickness, cv2.LINE_AA)
+
+        return tile
+
+
+def render_tile(image, overlay, x0, y0, width, height, scale):
+    """
+    Renders one output tile of the annotated image. (x0, y0) is the tile corner
+    in output pixels and only the matching part of the image is resampled.
+    """
+    sx0, sy0 = x0/scale, y0/scale
+    sx1 = min(image.shape[1], int(np.ceil((x0 + width)/scale)))
+    sy1 = min(image.shape[0], int(np.ceil((y0 + height)/scale)))
+    crop = image[int(sy0):sy1, int(sx0):sx1]
+
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    tile = cv2.resize(crop, (width, height), interpolation=interpolation)
+    if len(tile.shape) == 2:
+        tile = cv2.cvtColor(tile, cv2.COLOR_GRAY2BGR)
+
+    return overlay.draw(tile, int(sx0), int(sy0), scale)
+
+
+def output_size(image, scale):
+    return max(1, int(image.shape[1]*scale)), max(1, int(image.shape[0]*scale))
+
+
+def tiles(image, overlay, scale, tile_size, rgb=False, pad=False):
+    """
+    Yields (row, col, tile) for the tiles of the annotated image in row major
+    order. With pad, edge tiles are padded to tile_size as tiled TIFF requires.
+    """
+    width, height = output_size(image, scale)
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            w, h = min(tile_size, width - x0), min(tile_size, height - y0)
+            tile = render_tile(image, overlay, x0, y0, w, h, scale)
+            if rgb:
+                tile = cv2.cvtColor(tile, cv2.COLOR_BGR2RGB)
+            if pad and (w, h) != (tile_size, tile_size):
+                tile = cv2.copyMakeBorder(tile, 0, tile_size - h, 0, tile_size - w, cv2.BORDER_CONSTANT)
+            yield y0//tile_size, x0//tile_size, tile
+
+
+def write_tiff(path, image, overlay, scale=1.0, tile_size=512, compression='zlib'):
+    """
+    Writes a tiled, pyramidal TIFF. Tiles are rendered as tifffile consumes
+    them, so the full size annotated image is never held in memory.
+    """
+    if tifffile is None:
+        raise RuntimeError('Writing TIFF exports requires the tifffile package')
+
+    levels = []
+    s = scale
+    while True:
+        levels.append(s)
+        width, height = output_size(image, s)
+        if max(width, height) <= tile_size:
+            break
+        s /= 2.0
+
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        for i, s in enumerate(levels):
+            width, height = output_size(image, s)
+            data = (tile for _, _, tile in tiles(image, overlay, s, tile_size, rgb=True, pad=True))
+            tif.write(data, shape=(height, width, 3), dtype=np.uint8, tile=(tile_size, tile_size),
+                      photometric='rgb', compression=compression,
+                      subifds=len(levels) - 1 if i == 0 else None,
+                      subfiletype=1 if i > 0 else 0)
+
+
+def write_chunks(directory, image, overlay, fmt='png', scale=1.0, tile_size=2048, quality=90, compression=3):
+    """
+    Writes the annotated image as a grid of PNG or JPEG files named
+    <row>_<col>.<fmt> in directory, one tile at a time.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if fmt == 'png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+    else:
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    for row, col, tile in tiles(image, overlay, scale, tile_size):
+        cv2.imwrite(os.path.join(directory, '%03d_%03d.%s'%(row, col, fmt)), tile, params)
+
+
+def export_mount(source, recipe, output_dir, fmt='tiff', scale=1.0, tile_size=None, **options):
+    """
+    Runs a mount with a recipe and writes its spot file and annotated image.
+    Spots are numbered in the same order as in the spot file. Returns the path
+    of the annotated image, or None if the mount could not be loaded.
+    """
+    result = run_mount(source, recipe)
+    if result is None:
+        return None
+    image, _, finder, targeter, coords, stage = result
+
+    write_spots(spots_path(source, output_dir), coords, stage)
+
+    spot_size = targeter.spot_size if targeter is not None else 0
+    overlay = Overlay(finder.contours(), coords, spot_size)
+
+    if fmt == 'tiff' and tifffile is None:
+        print('tifffile is not installed, exporting PNG tiles instead')
+        fmt = 'png'
+        options.pop('compression', None)
+
+    root = os.path.join(output_dir, file_root(source) + '_annotated')
+    if fmt == 'tiff':
+        path = root + '.tiff'
+        write_tiff(path, image, overlay, scale, tile_size or 512, **options)
+    else:
+        path = root
+        write_chunks(path, image, overlay, fmt, scale, tile_size or 2048, **options)
+
+    return path
+
+
+def export_mounts(sources, recipe, output_dir, workers=2, **options):
+    """
+    Exports several mounts in parallel worker processes, see export_mount.
+    Returns the output paths in the order of sources, None for mounts that
+    could not be loaded or failed. Failures and the end of the export are
+    printed, as nobody waits on the thread this usually runs on.
+    """
+    paths = []
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(export_mount, source, recipe, output_dir, **options) for source in sources]
+        for source, future in zip(sources, futures):
+            try:
+                path = future.result()
+                if path is None:
+                    print('Could not load %s for export'%source)
+                else:
+                    print('Exported %s to %s'%(source, path))
+            except Exception as e:
+                path = None
+                print('Exporting %s failed: %s'%(source, e))
+            paths.append(path)
+
+    print('Export finished: %i of %i mounts written to %s'%(len([p for p in paths if p is not None]), len(sources), output_dir))
+    return paths
@@ -2,26 +2,84 @@ import cv2
 import numpy as np
 from functools import partial
 
-from PyQt5.QtWidgets import QCheckBox, QLineEdit, QSlider, QComboBox
+from PyQt5.QtWidgets import QCheckBox, QLineEdit, QSlider, QComboBox, QLabel
 from PyQt5.QtCore import Qt, pyqtSignal, QObject
 
-class BaseFinder(QObject):
+from .grains import label_binary, relabel_in_place, central_moments, hu_moments
+from . import shapes
+from .contours import ContourStore
+from .smoothing import median_blur, gaussian_blur
+from . import morphology
+from . import memory
+from . import colors
+from .history import SettingsHistory, HistoryMixin
+
+class BaseFinder(QObject, HistoryMixin):
     
     _binary_image = None
+    _labelled = None
+    _labels = None
+    _stats = None
+    _centroids = None
+    _contours = None
+    _shapes = None
+
+    # Grains smaller than this (in pixels) are not accepted
+    min_area = 1000
+
+    # The region of interest (see LACV.roi), None to process the whole image
+    roi = None
+
+    # The global finder filters, see LACVController.global_finder_settings
+    filters = None
+
+    # Grains classified as one of these reference shapes are rejected when the match filter is on
+    rejected_shapes = ('crack',)
+
+    # The threshold level found over the whole ROI by roi_level, used by
+    # threshold() while the regions of an ROI are processed
+    _level = None
+
+    settings = {}
 
     changed = pyqtSignal()
+    restored = pyqtSignal()
 
     def __init__(self, input_image):
         QObject.__init__(self, None)
         self._input_image = input_image
-        self.settings = {}
+        self.settings = {k: dict(v) for k, v in type(self).settings.items()}
+        self.history = SettingsHistory(self.setting_values())
 
-    def make_binary(self, image):
+    def threshold(self, image):
         """
-        Takes in an image and returns grain boundery polygons.
+        Takes in an image and returns a binary image of its grains.
         """
         pass
 
+    def roi_level(self):
+        """
+        For finders that pick their threshold level from the image, returns
+        the level for the whole ROI so that every region is cut at the same
+        one. None for finders with fixed or local levels.
+        """
+        return None
+
+    def make_binary(self):
+        """
+        Thresholds the input image, only within the regions of the ROI if there is one.
+        """
+        with memory.stage('threshold'):
+            if self.roi is None:
+                self._binary_image = self.threshold(self._input_image)
+            else:
+                self._level = self.roi_level()
+                try:
+                    self._binary_image = self.roi.apply(self._input_image, self.threshold)
+                finally:
+                    self._level = None
+        return self._binary_image
+
     def boundaries(self, base_image):
         """
         Given a base image returns an image with boundaries drawn and the accepted contours.
@@ -30,67 +88,185 @@ class BaseFinder(QObject):
         if self._binary_image is None:
             return base_image
 
-        contours, hierarchy = cv2.findContours(self._binary_image, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-        ex = np.zeros([100, 100], dtype=np.uint8)
-        exim = cv2.ellipse(ex, (50, 50), (60, 30), 0, 0, 360, 1, 1)
-        exc, _ = cv2.findContours(exim, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        exc = exc[0]
-        img_with_boundaries = base_image.copy()
-        img_with_boundaries[:] = (255, 255, 255)
-        
-        good_contours = []
-        font = cv2.FONT_HERSHEY_SIMPLEX
+        good_contours = self.contours()
 
-        for i, cnt in enumerate(contours):
-            if hierarchy[0][i][3] <= 0:
-                try:
-                    area = cv2.contourArea(cnt)
-                    match = cv2.matchShapes(exc, cnt, cv2.CONTOURS_MATCH_I2, 0)            
-                    circularity = 4*3.14*cv2.contourArea(cnt) / (cv2.arcLength(cnt, True)**2)
-                    convexity = cv2.contourArea(cnt)/cv2.contourArea(cv2.convexHull(cnt))
-                except:
-                    area = 0
-                    match = 0
-                    circularity = 0
-                    convexity = 0
+        # In low memory mode the canvas is grey, a third of the size
+        with memory.stage('boundaries'):
+            shape = base_image.shape[:2] if memory.low_memory else base_image.shape[:2] + (3,)
+            img_with_boundaries = np.full(shape, 255, dtype=np.uint8)
 
-
-                print("%f\t%f\t%f\t%f"%(match, circularity, convexity, area))
-
-                if area < 1000:
-                    continue
-
-                #if match < 0.01 or circularity < 0.75 or convexity < 0.8:
-                #    continue
-                color = np.random.randint(0, 255, (3)).tolist()
-                try:
-                    M = cv2.moments(cnt)
-                    cX = int(M["m10"] / M["m00"])
-                    cY = int(M["m01"] / M["m00"])
-                    
-                    #cv2.putText(img_with_boundaries, "%f, %f, %f"%(match, circularity, convexity), (cX, cY), font, 1, (255, 255, 255), 1, cv2.LINE_AA)
-                except:
-                    pass
+            colors = np.random.randint(0, 255, (len(good_contours.parents), 3))
+            if memory.low_memory:
+                colors[:] = colors[:, :1]*200//255
+            for k, cnt in enumerate(good_contours.all_contours()):
+                parent = good_contours.parents[k]
+                color = colors[k if parent < 0 else parent].tolist()
                 cv2.drawContours(img_with_boundaries, [cnt], 0, color, 8)
-                good_contours.append(cnt)
 
-        #cv2.imwrite('/Users/japetrus/Desktop/cont.png', img_with_boundaries)
-        self._contours = good_contours
         return (img_with_boundaries, good_contours)
 
     def contours(self):
+        """
+        Returns the ContourStore of the accepted grains, contour i belonging to label i + 1.
+        """
+        self._update_labels()
         return self._contours
 
+    def labels(self):
+        """
+        Returns the int32 label image of the accepted grains, 0 being background.
+        """
+        self._update_labels()
+        return self._labels
+
+    def stats(self):
+        """
+        Returns the connectedComponentsWithStats table of the accepted grains, indexed by label.
+        """
+        self._update_labels()
+        return self._stats
+
+    def centroids(self):
+        self._update_labels()
+        return self._centroids
+
+    def shapes(self):
+        """
+        Returns the name of the closest reference shape of every accepted grain.
+        """
+        self._update_labels()
+        return self._shapes
+
+    def set_filters(self, filters):
+        self.filters = filters
+        self._labelled = None
+        self.history.clear_results()
+
+    def set_roi(self, roi):
+        self.roi = roi
+        self._binary_image = None
+        self._labelled = None
+        self.history.clear_results()
+
+    def grain_features(self, labels, stats, contours):
+        """
+        Computes the filter quantities of every grain as arrays, in label order.
+        Convexity needs a hull per grain so it is only computed when its filter is on.
+        """
+        area = stats[1:, cv2.CC_STAT_AREA].astype(np.float64)
+        perimeter = contours.perimeters()
+        hu = hu_moments(central_moments(labels, len(stats)))[1:]
+        names, classes, match = shapes.classify(hu, self.rejected_shapes)
+
+        features = {
+            'area': area,
+            'circularity': 4*np.pi*area/np.maximum(perimeter, 1)**2,
+            'match': match,
+            'shape': np.array(names, dtype=object)[classes]
+        }
+
+        if self.filters and self.filters.get('convexity', {}).get('enabled'):
+            hull = np.array([cv2.contourArea(cv2.convexHull(c)) for c in contours])
+            features['convexity'] = np.array([cv2.contourArea(c) for c in contours])/np.maximum(hull, 1)
+
+        return features
+
+    def find_grains(self, binary):
+        """
+        Labels the grains of a binary image and applies the global filters.
+        Returns (labels, stats, centroids, contours, shapes) for the kept grains.
+        """
+        labels, stats, centroids = label_binary(binary, self.min_area)
+        mask = cv2.compare(labels, 0, cv2.CMP_GT)
+        contours = ContourStore.find(mask, labels)
+        del mask
+
+        features = self.grain_features(labels, stats, contours)
+        keep = np.ones(len(stats) - 1, dtype=bool)
+        for name, f in (self.filters or {}).items():
+            if f['enabled'] and name in features:
+                keep &= (features[name] >= float(f['min'])) & (features[name] <= float(f['max']))
+        if self.filters and self.filters.get('match', {}).get('enabled'):
+            keep &= ~np.isin(features['shape'], self.rejected_shapes)
+
+        if not keep.all():
+            relabel = np.zeros(len(stats), dtype=np.int32)
+            relabel[1:][keep] = np.arange(1, keep.sum() + 1)
+            relabel_in_place(labels, relabel)
+            stats = np.concatenate([stats[:1], stats[1:][keep]])
+            centroids = np.concatenate([centroids[:1], centroids[1:][keep]])
+            contours = contours.select(np.nonzero(keep)[0])
+
+        return labels, stats, centroids, contours, features['shape'][keep]
+
+    def _update_labels(self):
+        if self._binary_image is None or self._labelled is self._binary_image:
+            return
+
+        with memory.stage('grains'):
+            if self.roi is None:
+                found = self.find_grains(self._binary_image)
+            else:
+                found = self._find_grains_in_regions()
+
+        self._labels, self._stats, self._centroids, self._contours, self._shapes = found
+        self._labelled = self._binary_image
+
+    def _find_grains_in_regions(self):
+        """
+        Finds grains region by region and joins the results in full image
+        coordinates. Grains never cross regions, so label numbers are simply
+        offset by the grain count of the preceding regions.
+        """
+        height, width = self._binary_image.shape[:2]
+        labels = np.zeros((height, width), dtype=np.int32)
+        stats, centroids, stores, offsets, names = [], [], [], [], []
+        count = 0
+
+        for x0, y0, binary in self.roi.views(self._binary_image):
+            l, st, c, store, shape_names = self.find_grains(binary)
+            h, w = binary.shape[:2]
+            np.add(l, count, out=l, where=l > 0)
+            labels[y0:y0 + h, x0:x0 + w] = l
+            stats.append(st[1:] + [x0, y0, 0, 0, 0])
+            centroids.append(c[1:] + [x0, y0])
+            stores.append(store)
+            offsets.append((x0, y0))
+            names.append(shape_names)
+            count += len(st) - 1
+
+        stats = np.concatenate([np.zeros((1, 5), dtype=np.int32)] + stats)
+        stats[0] = [0, 0, width, height, height*width - stats[1:, cv2.CC_STAT_AREA].sum()]
+        centroids = np.concatenate([np.zeros((1, 2))] + centroids)
+        names = np.concatenate(names) if names else np.zeros(0, dtype=object)
+
+        return labels, stats, centroids, ContourStore.concatenate(stores, offsets), names
+
     def binary_image(self):
         return self._binary_image
 
     def set_setting(self, setting_name, setting_value):
         self.settings[setting_name]['value'] = self.settings[setting_name]['type'](setting_value)
+        self.history.push(self.setting_values())
         self.changed.emit()
 
     def get_image(self):
-        self.make_binary()
-        return self.boundaries(self._input_image)[0]
+        results = self.history.results(self.setting_values())
+        if 'image' not in results:
+            self.make_binary()
+            results['image'] = self.boundaries(self._input_image)[0]
+            results['binary'] = self._binary_image
+            results['contours'] = self._contours
+            results['labels'] = (self.labels(), self.stats(), self.centroids())
+            results['shapes'] = self._shapes
+        else:
+            self._binary_image = results['binary']
+            self._contours = results['contours']
+            self._labels, self._stats, self._centroids = results['labels']
+            self._shapes = results['shapes']
+            self._labelled = self._binary_image
+
+        return results['image']
 
 class ThresholdFinder(BaseFinder):
     """
@@ -128,6 +304,13 @@ class ThresholdFinder(BaseFinder):
             'value': 11,
             'setup': [lambda w: w.setMinimum(3), lambda w: w.setMaximum(101)]
         },
+        'exact_smoothing': {
+            'type': bool,
+            'control': QCheckBox,
+            'label': 'Exact smoothing',
+            'value': False,
+            'setup': []
+        },
         'open': {
             'type': bool,
             'control': QCheckBox,
@@ -141,31 +324,34 @@ class ThresholdFinder(BaseFinder):
             'label': 'Opening kernel size',
             'value': 7,
             'setup': [lambda w: w.setMinimum(3), lambda w: w.setMaximum(101)]
+        },
+        'kernel_shape': {
+            'type': int,
+            'control': QComboBox,
+            'label': 'Kernel shape',
+            'value': morphology.SQUARE,
+            'setup': [lambda w: w.addItem("Square", morphology.SQUARE), lambda w: w.addItem("Disk", morphology.DISK)]
         }
     }
 
     def __init__(self, input_image):
         BaseFinder.__init__(self, input_image)
 
-    def make_binary(self):  
-        imggray = cv2.cvtColor(self._input_image, cv2.COLOR_RGB2GRAY)
+    def threshold(self, image):
+        imggray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
         if self.settings['smooth']['value'] == True:
             v = self.settings['smooth_size']['value']
-            if v % 2 == 0:
-                v += 1
-            imggray = cv2.medianBlur(imggray, v)
+            imggray = median_blur(imggray, v, self.settings['exact_smoothing']['value'])
 
         lower = self.settings['lower']['value']
         upper = self.settings['upper']['value']
         thresh = cv2.inRange(imggray, lower, upper)    
         
         if self.settings['open']['value'] == True:
-            ks = self.settings['kernel_size']['value']            
-            kernel = np.ones((ks, ks), np.uint8)
-            thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-        self._binary_image = thresh
-        return self._binary_image
+            ks = self.settings['kernel_size']['value']
+            thresh = morphology.open_binary(thresh, ks, self.settings['kernel_shape']['value'])
+        return thresh
         
 class AdaptiveThresholdFinder(BaseFinder):
     """
@@ -203,8 +389,8 @@ class AdaptiveThresholdFinder(BaseFinder):
         BaseFinder.__init__(self, input_image)
         self.settings['block_size']['setup'][1] = lambda w: w.setMaximum(input_image.shape[0]/2.0)
 
-    def make_binary(self):  
-        imggray = cv2.cvtColor(self._input_image, cv2.COLOR_RGB2GRAY)
+    def threshold(self, image):
+        imggray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         imggray = cv2.medianBlur(imggray, 5)
 
         method = self.settings['method']['value']
@@ -214,13 +400,55 @@ class AdaptiveThresholdFinder(BaseFinder):
         c = self.settings['c']['value']
         
         thresh = cv2.adaptiveThreshold(imggray, 255, method, cv2.THRESH_BINARY, block_size, c)
-        kernel = np.ones((11, 11), np.uint8)
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-        self._binary_image = thresh
-        return self._binary_image
+        thresh = morphology.open_square(thresh, 11)
+        return thresh
+
+
+def otsu_level(hist):
+    """
+    Otsu's threshold level for a 256 bin histogram, the same as
+    cv2.threshold with THRESH_OTSU finds for the image it came from.
+    """
+    hist = np.asarray(hist, dtype=np.float64).ravel()
+    levels = np.arange(len(hist))
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist*levels)
+    m1 = m0[-1] - m0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = w0*w1*(m0/w0 - m1/w1)**2
+    return int(np.argmax(np.nan_to_num(between, nan=-1)))
+
+
+class OtsuMixin:
+    """
+    Thresholding of the smoothed grey image at Otsu's level, for finders with
+    blur_size and exact_smoothing settings.
+
+    Within an ROI the level is found once, from the histogram of all the ROI
+    pixels, and every region is cut at it. It is the level of the ROI, not of
+    the full frame: when the frame outside the ROI weighs on Otsu's split (a
+    mount on a black background, say), ROI and full frame runs segment
+    differently.
+    """
+
+    def smoothed(self, image):
+        imggray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        k = self.settings['blur_size']['value']
+        return gaussian_blur(imggray, k, self.settings['exact_smoothing']['value'])
+
+    def roi_level(self):
+        return otsu_level(self.roi.histogram(self._input_image, self.smoothed))
+
+    def otsu(self, blur):
+        if self._level is None:
+            _, th = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+        else:
+            _, th = cv2.threshold(blur, self._level, 255, cv2.THRESH_BINARY)
+        return th
 
 
-class OtsuThresholdFinder(BaseFinder):
+class OtsuThresholdFinder(OtsuMixin, BaseFinder):
     """
     A finder that uses Otsu thresholding to construct
     binary image and find contours.
@@ -235,22 +463,224 @@ class OtsuThresholdFinder(BaseFinder):
             'label': 'Blur size',
             'value': 5,
             'setup': [lambda w: w.setMinimum(3), lambda w: w.setMaximum(200)]
+        },
+        'exact_smoothing': {
+            'type': bool,
+            'control': QCheckBox,
+            'label': 'Exact smoothing',
+            'value': False,
+            'setup': []
         }
     }
 
     def __init__(self, input_image):
         BaseFinder.__init__(self, input_image)
 
-    def make_binary(self):  
-        imggray = cv2.cvtColor(self._input_image, cv2.COLOR_RGB2GRAY)
-        k = self.settings['blur_size']['value']
-        if k % 2 == 0:
-            k += 1
-        blur = cv2.GaussianBlur(imggray, (k,k), 0)
-        ret, th = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+    def threshold(self, image):
+        return self.otsu(self.smoothed(image))
 
-        self._binary_image = th
-        return self._binary_image
 
+class WatershedFinder(OtsuMixin, BaseFinder):
+    """
+    A finder that separates touching grains using markers taken
+    from the distance transform of an Otsu thresholded image and
+    marker-controlled watershed segmentation.
+    """
+
+    name = "Watershed"
+
+    settings = {
+        'blur_size': {
+            'type': int,
+            'control': partial(QSlider, Qt.Horizontal),
+            'label': 'Blur size',
+            'value': 5,
+            'setup': [lambda w: w.setMinimum(3), lambda w: w.setMaximum(200)]
+        },
+        'exact_smoothing': {
+            'type': bool,
+            'control': QCheckBox,
+            'label': 'Exact smoothing',
+            'value': False,
+            'setup': []
+        },
+        'separation': {
+            'type': int,
+            'control': partial(QSlider, Qt.Horizontal),
+            'label': 'Marker separation',
+            'value': 41,
+            'setup': [lambda w: w.setMinimum(3), lambda w: w.setMaximum(301)]
+        },
+        'marker_fraction': {
+            'type': int,
+            'control': partial(QSlider, Qt.Horizontal),
+            'label': 'Marker fraction (%)',
+            'value': 70,
+            'setup': [lambda w: w.setMinimum(1), lambda w: w.setMaximum(99)]
+        }
+    }
+
+    def __init__(self, input_image):
+        BaseFinder.__init__(self, input_image)
+
+    def threshold(self, image):
+        th = self.otsu(self.smoothed(image))
+        th = cv2.morphologyEx(th, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+
+        # Markers are the parts of each grain that are close to the local
+        # maximum of the distance transform, i.e. the grain cores.
+        dist = cv2.distanceTransform(th, cv2.DIST_L2, 5)
+        s = self.settings['separation']['value']
+        if s % 2 == 0:
+            s += 1
+        localmax = cv2.dilate(dist, np.ones((s, s), np.uint8))
+        fraction = self.settings['marker_fraction']['value']/100.0
+        sure_fg = ((dist >= fraction*localmax) & (dist > 1)).astype(np.uint8)
+        _, markers = cv2.connectedComponents(sure_fg)
+
+        # 0 is the unknown region to flood, 1 the background and 2.. the grains
+        markers += 1
+        markers[(th > 0) & (sure_fg == 0)] = 0
+
+        relief = cv2.normalize(dist, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+        relief = cv2.cvtColor(255 - relief, cv2.COLOR_GRAY2BGR)
+        markers = cv2.watershed(relief, markers)
+
+        # Cut the watershed lines into the binary image so that touching
+        # grains come out as separate contours.
+        lines = cv2.dilate((markers == -1).astype(np.uint8), np.ones((3, 3), np.uint8))
+        th = np.where((markers > 1) & (lines == 0), 255, 0).astype(np.uint8)
+
+        return th
+
+
+def color_samples(value):
+    return tuple(tuple(int(c) for c in sample) for sample in value)
+
+
+class ColorFinder(BaseFinder):
+    """
+    A finder that classifies pixels by colour in HSV or Lab space,
+    either by channel ranges or by closeness to sampled colours,
+    through a lookup table over all quantized BGR colours.
+    """
+
+    name = "Colour Classification"
+
+    settings = {
+        'space': {
+            'type': int,
+            'control': QComboBox,
+            'label': 'Colour space',
+            'value': colors.HSV,
+            'setup': [lambda w: w.addItem("HSV", colors.HSV), lambda w: w.addItem("Lab", colors.LAB)]
+        },
+        'c1_min': {
+            'type': int,
+            'control': QLineEdit,
+            'label': 'H/L min',
+            'value': 0,
+            'setup': []
+        },
+        'c1_max': {
+            'type': int,
+            'control': QLineEdit,
+            'label': 'H/L max',
+            'value': 255,
+            'setup': []
+        },
+        'c2_min': {
+            'type': int,
+            'control': QLineEdit,
+            'label': 'S/a min',
+            'value': 0,
+            'setup': []
+        },
+        'c2_max': {
+            'type': int,
+            'control': QLineEdit,
+            'label': 'S/a max',
+            'value': 255,
+            'setup': []
+        },
+        'c3_min': {
+            'type': int,
+            'control': QLineEdit,
+            'label': 'V/b min',
+            'value': 170,
+            'setup': []
+        },
+        'c3_max': {
+            'type': int,
+            'control': QLineEdit,
+            'label': 'V/b max',
+            'value': 255,
+            'setup': []
+        },
+        'samples': {
+            'type': color_samples,
+            'control': QLabel,
+            'label': 'Samples',
+            'value': (),
+            'setup': []
+        },
+        'tolerance': {
+            'type': int,
+            'control': partial(QSlider, Qt.Horizontal),
+            'label': 'Sample tolerance',
+            'value': 40,
+            'setup': [lambda w: w.setMinimum(1), lambda w: w.setMaximum(150)]
+        },
+        'open': {
+            'type': bool,
+            'control': QCheckBox,
+            'label': 'Open',
+            'value': True,
+            'setup': []
+        },
+        'kernel_size': {
+            'type': int,
+            'control': partial(QSlider, Qt.Horizontal),
+            'label': 'Opening kernel size',
+            'value': 7,
+            'setup': [lambda w: w.setMinimum(3), lambda w: w.setMaximum(101)]
+        }
+    }
+
+    _lut = None
+    _lut_key = None
 
-        
\ No newline at end of file
+    def __init__(self, input_image):
+        BaseFinder.__init__(self, input_image)
+        self.settings['samples']['setup'] = [lambda w: w.setText('%i'%len(self.settings['samples']['value']))]
+
+    def lut(self):
+        """
+        Returns the lookup table for the current settings, rebuilt only when they change.
+        """
+        s = {k: v['value'] for k, v in self.settings.items()}
+        key = (s['space'], s['c1_min'], s['c1_max'], s['c2_min'], s['c2_max'], s['c3_min'], s['c3_max'],
+               s['samples'], s['tolerance'])
+        if key != self._lut_key:
+            lower = (s['c1_min'], s['c2_min'], s['c3_min'])
+            upper = (s['c1_max'], s['c2_max'], s['c3_max'])
+            self._lut = colors.build_lut(s['space'], lower, upper, s['samples'], s['tolerance'])
+            self._lut_key = key
+        return self._lut
+
+    def add_sample(self, x, y):
+        """
+        Adds the colour around (x, y) in the input image to the samples.
+        """
+        sample = colors.sample_color(self._input_image, x, y)
+        self.set_setting('samples', self.settings['samples']['value'] + (sample,))
+
+    def clear_samples(self):
+        self.set_setting('samples', ())
+
+    def threshold(self, image):
+        thresh = colors.apply_lut(image, self.lut())
+
+        if self.settings['open']['value'] == True:
+            thresh = morphology.open_binary(thresh, self.settings['kernel_size']['value'], morphology.SQUARE)
+        return thresh
@@ -1,20 +1,61 @@
+import cv2
+import numpy as np
 
-class BaseGenerator(object):
-    pass
+from PyQt5.QtCore import pyqtSignal, QObject
 
 
-class ChromiumGenerator(BaseGenerator):
+class BaseGenerator(QObject):
+    """
+    Turns the spots of a targeter, in the order the stage visits them, into a
+    sequence for an instrument.
+    """
 
-    name = "Chromium"
+    settings = {}
+
+    # The spots in sequence order, in image coordinates
+    sequence = []
+
+    _base_image = None
+
+    changed = pyqtSignal()
 
     def __init__(self):
-        pass
+        QObject.__init__(self, None)
+        self.settings = {k: dict(v) for k, v in type(self).settings.items()}
 
+    def set_sequence(self, base_image, coords):
+        self._base_image = base_image
+        self.sequence = list(coords)
+        self.changed.emit()
 
-class GeoStarGenerator(BaseGenerator):
+    def set_setting(self, setting_name, setting_value):
+        self.settings[setting_name]['value'] = self.settings[setting_name]['type'](setting_value)
+        self.changed.emit()
 
-    name = "GeoStar"
+    def get_image(self):
+        """
+        Returns the base image with the sequence drawn as a numbered path.
+        """
+        if self._base_image is None:
+            return np.zeros((1, 1, 3), dtype=np.uint8)
 
-    def __init__(self):
-        pass
+        image = self._base_image.copy()
+        if len(image.shape) == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+
+        points = np.round(np.asarray(self.sequence, dtype=np.float64).reshape(-1, 2)).astype(np.int32)
+        cv2.polylines(image, [points], False, (0, 160, 255), 4)
+        for i, (x, y) in enumerate(points):
+            cv2.putText(image, str(i + 1), (int(x) + 10, int(y) - 10), cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 160, 255), 4)
+
+        return image
 
+
+class ChromiumGenerator(BaseGenerator):
+
+    name = "Chromium"
+
+
+class GeoStarGenerator(BaseGenerator):
+
+    name = "GeoStar"
@@ -0,0 +1,137 @@
+import cv2
+import numpy as np
+
+# Rows handled at a time by the strip-wise label passes, which keeps their
+# temporaries small next to the label image itself
+STRIP_ROWS = 512
+
+
+def label_binary(binary, min_area=0, connectivity=8):
+    """
+    Labels the connected components of a binary image and drops those
+    smaller than min_area pixels.
+
+    Returns (labels, stats, centroids) where labels is an int32 image with
+    the kept grains numbered 1..n, and stats/centroids are the matching
+    connectedComponentsWithStats tables indexed by label (row 0 is the
+    background).
+    """
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=connectivity, ltype=cv2.CV_32S)
+
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+    keep[0] = True
+
+    if not keep.all():
+        relabel = np.zeros(n, dtype=np.int32)
+        relabel[keep] = np.arange(keep.sum(), dtype=np.int32)
+        relabel_in_place(labels, relabel)
+        stats = stats[keep]
+        centroids = centroids[keep]
+
+    return labels, stats, centroids
+
+
+def relabel_in_place(labels, lut):
+    """
+    Maps every label through lut, overwriting the label image.
+    """
+    for y in range(0, labels.shape[0], STRIP_ROWS):
+        labels[y:y + STRIP_ROWS] = lut[labels[y:y + STRIP_ROWS]]
+    return labels
+
+
+def central_moments(labels, n=None):
+    """
+    Computes the area and central moments up to third order of every label.
+
+    Pixel coordinates are taken relative to each grain's centroid before the
+    sums, so the higher orders do not lose precision on large images. Returns
+    a dict of (n,) float arrays indexed by label: 'm00' and 'mu20', 'mu11',
+    'mu02', 'mu30', 'mu21', 'mu12', 'mu03'.
+    """
+    if n is None:
+        n = int(labels.max()) + 1
+
+    # Two passes over strips of rows: centroids first, then the moments about them
+    m00 = np.zeros(n)
+    sx = np.zeros(n)
+    sy = np.zeros(n)
+    for y0, ys, xs, grains in _label_strips(labels):
+        m00 += np.bincount(grains, minlength=n)
+        sx += np.bincount(grains, xs, minlength=n)
+        sy += np.bincount(grains, ys, minlength=n)
+
+    area = np.where(m00 > 0, m00, 1)
+    cx, cy = sx/area, sy/area
+
+    orders = [(2, 0), (1, 1), (0, 2), (3, 0), (2, 1), (1, 2), (0, 3)]
+    moments = {'m00': m00}
+    for p, q in orders:
+        moments['mu%i%i'%(p, q)] = np.zeros(n)
+
+    for y0, ys, xs, grains in _label_strips(labels):
+        dx = xs - cx[grains]
+        dy = ys - cy[grains]
+        for p, q in orders:
+            moments['mu%i%i'%(p, q)] += np.bincount(grains, dx**p*dy**q, minlength=n)
+
+    return moments
+
+
+def _label_strips(labels):
+    """
+    Yields (y0, ys, xs, grains) for the labelled pixels of each strip of rows,
+    with ys in image rows.
+    """
+    for y0 in range(0, labels.shape[0], STRIP_ROWS):
+        strip = labels[y0:y0 + STRIP_ROWS]
+        ys, xs = np.nonzero(strip)
+        yield y0, ys + y0, xs, strip[ys, xs]
+
+
+def hu_moments(moments):
+    """
+    Computes the seven Hu invariants from central_moments output, as an (n, 7) array.
+    """
+    m00 = np.where(moments['m00'] > 0, moments['m00'], 1)
+
+    def nu(p, q):
+        return moments['mu%i%i'%(p, q)]/m00**(1 + (p + q)/2.0)
+
+    n20, n11, n02 = nu(2, 0), nu(1, 1), nu(0, 2)
+    n30, n21, n12, n03 = nu(3, 0), nu(2, 1), nu(1, 2), nu(0, 3)
+
+    a, b = n30 + n12, n21 + n03
+    c, d = n30 - 3*n12, 3*n21 - n03
+
+    return np.stack([
+        n20 + n02,
+        (n20 - n02)**2 + 4*n11**2,
+        c**2 + d**2,
+        a**2 + b**2,
+        c*a*(a**2 - 3*b**2) + d*b*(3*a**2 - b**2),
+        (n20 - n02)*(a**2 - b**2) + 4*n11*a*b,
+        d*a*(a**2 - 3*b**2) - c*b*(3*a**2 - b**2)
+    ], axis=1)
+
+
+def ellipse_axes(labels, n=None):
+    """
+    Computes, for every label, the major and minor axis lengths of the ellipse
+    with the same second order moments as the grain.
+
+    Returns an (n, 2) float array indexed by label, row 0 being the background.
+    """
+    moments = central_moments(labels, n)
+    m00 = np.where(moments['m00'] > 0, moments['m00'], np.nan)
+    mu20 = moments['mu20']/m00
+    mu02 = moments['mu02']/m00
+    mu11 = moments['mu11']/m00
+
+    # For a filled ellipse the variance along an axis is (axis length/4)**2
+    common = np.sqrt(((mu20 - mu02)/2.0)**2 + mu11**2)
+    mean = (mu20 + mu02)/2.0
+    axes = 4.0*np.sqrt(np.clip(np.stack([mean + common, mean - common], axis=1), 0, None))
+    axes[0] = 0
+
+    return np.nan_to_num(axes)
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+
+from . import memory
+
+
+def snapshot(values):
+    """
+    Returns an immutable, hashable snapshot of a dict of setting values.
+    """
+    return tuple(sorted(values.items()))
+
+
+class SettingsHistory:
+    """
+    An undo/redo stack of settings snapshots for one finder or targeter.
+
+    Results computed for a snapshot (binary image, contours, spots...) are kept
+    in a dict per snapshot. Only the max_cached most recently used snapshots
+    keep their results, so going back to a recent configuration, or flipping
+    between two, does not recompute anything. In low memory mode only the
+    current snapshot keeps its results by default.
+    """
+
+    def __init__(self, values, max_cached=None):
+        self._snapshots = [snapshot(values)]
+        self._index = 0
+        self._other = None
+        self._results = OrderedDict()
+        if max_cached is None:
+            max_cached = 1 if memory.low_memory else 8
+        self.max_cached = max_cached
+
+    def current(self):
+        return self._snapshots[self._index]
+
+    def values(self):
+        return dict(self.current())
+
+    def push(self, values):
+        """
+        Records new setting values, dropping anything that could be redone.
+        """
+        s = snapshot(values)
+        if s == self.current():
+            return
+        self._other = self.current()
+        del self._snapshots[self._index + 1:]
+        self._snapshots.append(s)
+        self._index += 1
+
+    def can_undo(self):
+        return self._index > 0
+
+    def can_redo(self):
+        return self._index < len(self._snapshots) - 1
+
+    def undo(self):
+        """
+        Steps back one snapshot. Returns its values, or None if there is none.
+        """
+        if not self.can_undo():
+            return None
+        self._other = self.current()
+        self._index -= 1
+        return self.values()
+
+    def redo(self):
+        if not self.can_redo():
+            return None
+        self._other = self.current()
+        self._index += 1
+        return self.values()
+
+    def toggle(self):
+        """
+        Switches to the snapshot that was current before the last change, for
+        A/B comparisons. Returns its values, or None if there is none.
+        """
+        if self._other is None or self._other not in self._snapshots:
+            return None
+        other, self._other = self._other, self.current()
+        self._index = len(self._snapshots) - 1 - self._snapshots[::-1].index(other)
+        return self.values()
+
+    def results(self, values=None):
+        """
+        Returns the (mutable) results dict of the snapshot of values, or of the
+        current snapshot, marking it as most recently used.
+        """
+        s = self.current() if values is None else snapshot(values)
+        if s in self._results:
+            self._results.move_to_end(s)
+        else:
+            self._results[s] = {}
+            while len(self._results) > self.max_cached:
+                self._results.popitem(last=False)
+        return self._results[s]
+
+    def clear_results(self):
+        self._results.clear()
+
+
+class HistoryMixin:
+    """
+    Undo/redo and A/B switching for modules with a settings dict, a history
+    attribute and restored/changed signals.
+    """
+
+    def setting_values(self):
+        return {k: v['value'] for k, v in self.settings.items()}
+
+    def load_settings(self, values):
+        """
+        Sets several setting values at once and records them as one snapshot.
+        """
+        for k, v in values.items():
+            if k in self.settings:
+                self.settings[k]['value'] = self.settings[k]['type'](v)
+        self.history.push(self.setting_values())
+
+    def _restore(self, values):
+        if values is None:
+            return False
+        for k, v in values.items():
+            self.settings[k]['value'] = v
+        self.restored.emit()
+        self.changed.emit()
+        return True
+
+    def undo(self):
+        return self._restore(self.history.undo())
+
+    def redo(self):
+        return self._restore(self.history.redo())
+
+    def toggle(self):
+        return self._restore(self.history.toggle())
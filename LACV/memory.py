@@ -0,0 +1,170 @@
+import os
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import cv2
+import numpy as np
+
+# Low memory mode: compact distance transforms computed in strips, reused
+# scratch buffers and a single cached result per module. Setting the
+# LACV_LOW_MEMORY environment variable turns it on, also in worker processes.
+low_memory = os.environ.get('LACV_LOW_MEMORY', '0') not in ('', '0')
+
+# Rows per strip of the float32 distance transform in low memory mode
+STRIP_ROWS = 512
+
+# Fixed point formats tried for compact distance transforms, as (dtype, steps per pixel)
+DISTANCE_FORMATS = [(np.uint8, 4), (np.uint16, 16)]
+
+_local = threading.local()
+
+
+def set_low_memory(enabled):
+    global low_memory
+    low_memory = bool(enabled)
+    os.environ['LACV_LOW_MEMORY'] = '1' if enabled else '0'
+    if not low_memory:
+        clear_scratch()
+
+
+def scratch(name, shape, dtype):
+    """
+    Returns a work array of the given shape and dtype, reusing the memory of
+    the last array asked for under name when it is large enough. Contents are
+    undefined. Buffers are kept per thread.
+    """
+    buffers = _local.__dict__.setdefault('buffers', {})
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))*dtype.itemsize
+
+    buffer = buffers.get(name)
+    if buffer is None or buffer.nbytes < size:
+        buffer = np.empty(size, dtype=np.uint8)
+        buffers[name] = buffer
+
+    return buffer[:size].view(dtype).reshape(shape)
+
+
+def buffer(name, shape, dtype):
+    """
+    A scratch array in low memory mode and None otherwise, for the dst
+    argument of OpenCV functions.
+    """
+    return scratch(name, shape, dtype) if low_memory else None
+
+
+def clear_scratch():
+    _local.__dict__.pop('buffers', None)
+
+
+def compact_distance(binary, max_distance, name='distance'):
+    """
+    The L2 (3x3 mask) distance transform of a binary image in fixed point,
+    uint8 in quarter pixels or uint16 in sixteenths of a pixel, whichever
+    holds max_distance. Returns (distance, steps per pixel), or the plain
+    float32 transform and 1 if neither does.
+
+    The float32 transform is only ever computed for strips of STRIP_ROWS rows,
+    overlapping their neighbours by more than max_distance, so values up to
+    max_distance are exact. Larger ones saturate. The result lives in a
+    scratch buffer and is overwritten by the next call with the same name.
+    """
+    for dtype, steps in DISTANCE_FORMATS:
+        top = np.iinfo(dtype).max
+        if (max_distance + 1)*steps <= top:
+            break
+    else:
+        return cv2.distanceTransform(binary, cv2.DIST_L2, 3), 1
+
+    height, width = binary.shape[:2]
+    distance = scratch(name, (height, width), dtype)
+    overlap = int(np.ceil(1.5*max_distance)) + 2
+
+    for y0 in range(0, height, STRIP_ROWS):
+        y1 = min(height, y0 + STRIP_ROWS)
+        a, b = max(0, y0 - overlap), min(height, y1 + overlap)
+        strip = cv2.distanceTransform(binary[a:b], cv2.DIST_L2, 3,
+                                      dst=scratch(name + '_strip', (b - a, width), np.float32))
+        strip = strip[y0 - a:y1 - a]
+        np.multiply(strip, steps, out=strip)
+        np.minimum(strip, top, out=strip)
+        np.rint(strip, out=strip)
+        distance[y0:y1] = strip
+
+    return distance, steps
+
+
+class MemoryReport:
+    """
+    Peak memory of each stage of a run, measured with tracemalloc. This covers
+    NumPy arrays, including those returned by OpenCV, but not temporaries that
+    OpenCV allocates internally.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            # Before Python 3.9 the peak is only reset by forgetting every
+            # trace, so memory freed from earlier allocations is not seen
+            tracemalloc.clear_traces()
+        before, _ = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            after, peak = tracemalloc.get_traced_memory()
+            self.stages.append((name, peak - before, after - before))
+
+    def peak(self):
+        return max([p for _, p, _ in self.stages] + [0])
+
+    def __str__(self):
+        lines = ['%-12s peak %9.1f MB  kept %9.1f MB'%(name, peak/2**20, kept/2**20)
+                 for name, peak, kept in self.stages]
+        return '\n'.join(lines)
+
+
+@contextmanager
+def reporting():
+    """
+    Collects a MemoryReport of the stages run by this thread within the block.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _local.report = MemoryReport()
+    try:
+        yield _local.report
+    finally:
+        _local.report = None
+        if started:
+            tracemalloc.stop()
+
+
+def stage(name):
+    """
+    Marks a stage for the memory report being collected, if any.
+    """
+    report = getattr(_local, 'report', None)
+    return report.stage(name) if report is not None else nullcontext()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print('usage: python -m LACV.memory SOURCE RECIPE [low]')
+        sys.exit(1)
+
+    # The pipeline reports to the package module, not to this __main__ copy
+    from . import memory
+    from .pipeline import run_mount, load_recipe
+
+    memory.set_low_memory(len(sys.argv) > 3 and sys.argv[3] == 'low')
+    with memory.reporting() as report:
+        run_mount(sys.argv[1], load_recipe(sys.argv[2]))
+    print(report)
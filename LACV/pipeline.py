@@ -0,0 +1,306 @@
+import os
+import csv
+import json
+import cv2
+import xml.etree.ElementTree as ET
+from math import cos, sin, radians
+import numpy as np
+
+from . import finders
+from . import targeters
+from .sequencing import order_spots
+from .roi import ROI
+from . import memory
+
+IMAGE_EXTENSIONS = ['bmp', 'jpg', 'png', 'tiff']
+
+# The modules a recipe may name, as offered by the controller
+FINDERS = [finders.ThresholdFinder, finders.AdaptiveThresholdFinder, finders.OtsuThresholdFinder,
+           finders.WatershedFinder, finders.ColorFinder]
+TARGETERS = [targeters.CoreTargeter, targeters.RimTargeter, targeters.MomentsTargeter,
+             targeters.SimpleBlobTargeter]
+
+
+def file_root(filename):
+    return os.path.basename(filename).split(".")[0]
+
+
+def file_extension(filename):
+    parts = os.path.basename(filename).split(".")
+    return parts[1].lower() if len(parts) > 1 else ""
+
+
+def is_image_file(filename):
+    return file_extension(filename) in IMAGE_EXTENSIONS
+
+
+def is_align_file(filename):
+    return file_extension(filename) == "align"
+
+
+def find_source_pair(source):
+    """
+    Given an image or .Align file, finds its complement in the same directory
+    with pair_sources. Returns (image_path, align_path), either of which is
+    None if not found.
+    """
+    source_dir = os.path.dirname(source)
+    name = os.path.basename(source)
+
+    for image_file, align_file in pair_sources(os.listdir(source_dir or '.')).values():
+        if name in (image_file, align_file):
+            return os.path.join(source_dir, image_file), os.path.join(source_dir, align_file)
+
+    return (None, source) if is_align_file(name) else (source, None)
+
+
+def pair_sources(filenames):
+    """
+    Groups a directory listing into image/.Align pairs. An image belongs to
+    the .Align file whose root name is the longest prefix of its own, e.g.
+    Mount1_stitched.png to Mount1.Align rather than to Mount.Align. An .Align
+    file with several images takes the one with exactly its root name, or
+    else the first in name order. Returns a dict of .Align root ->
+    (image_file, align_file) for complete pairs.
+    """
+    images = {}
+    aligns = {}
+    for file in sorted(filenames):
+        if is_image_file(file):
+            images.setdefault(file_root(file), file)
+        elif is_align_file(file):
+            aligns.setdefault(file_root(file), file)
+
+    pairs = {}
+    for image_root in sorted(images):
+        owners = [root for root in aligns if image_root.startswith(root)]
+        if not owners:
+            continue
+        root = max(owners, key=len)
+        if root not in pairs or image_root == root:
+            pairs[root] = (images[image_root], aligns[root])
+
+    return pairs
+
+
+def read_align(align_path):
+    """
+    Reads the rotation, center and size of the image from an .Align file.
+    """
+    align_root = ET.parse(align_path).getroot()
+    align = align_root.find('Alignment')
+    return {
+        'rotation': float(align.find('Rotation').text),
+        'center': [float(x) for x in align.find('Center').text.split(',')],
+        'size': [float(x) for x in align.find('Size').text.split(',')]
+    }
+
+
+def align_transform(image_shape, align):
+    """
+    Returns the affine transform taking image pixel coordinates to stage coordinates.
+    """
+    xc, yc = align['center'][0], align['center'][1]
+    xmin, ymin = xc - align['size'][0]/2.0, yc - align['size'][1]/2.0
+    xmax, ymax = xc + align['size'][0]/2.0, yc + align['size'][1]/2.0
+    r = -align['rotation']
+
+    def rot(x, y):
+        xp = xc + (x - xc)*cos(radians(r)) - (y-yc)*sin(radians(r))
+        yp = yc + (x - xc)*sin(radians(r)) - (y-yc)*cos(radians(r))
+        return xp, yp
+
+    src = np.float32([
+        [0, 0],
+        [0, image_shape[0]],
+        [image_shape[1], image_shape[0]]
+    ])
+    dst = np.float32([
+        rot(xmin, ymin),
+        rot(xmin, ymax),
+        rot(xmax, ymax)
+    ])
+    return cv2.getAffineTransform(src, dst)
+
+
+def image_to_stage(transform, coords):
+    """
+    Maps an (n, 2) array of image coordinates to stage coordinates.
+    """
+    points = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    return points.dot(transform[:, :2].T) + transform[:, 2]
+
+
+def load_source(source):
+    """
+    Loads a mount from either of its files. Returns (image, align, transform),
+    or None if the image/align pair is incomplete or unreadable.
+    """
+    image_path, align_path = find_source_pair(source)
+    if not image_path or not align_path:
+        return None
+
+    image = cv2.imread(image_path)
+    if image is None:
+        return None
+
+    align = read_align(align_path)
+    return image, align, align_transform(image.shape, align)
+
+
+def make_recipe(finder, targeter):
+    """
+    Captures the finder and targeter classes and setting values as a plain dict.
+    ROI polygons are drawn on one mount, so recipes only keep whether the
+    automatic mount mask is used.
+    """
+    recipe = {}
+    if finder is not None:
+        recipe['finder'] = type(finder).__name__
+        recipe['finder_settings'] = {k: v['value'] for k, v in finder.settings.items()}
+        if finder.filters is not None:
+            recipe['filters'] = finder.filters
+        if finder.roi is not None:
+            recipe['roi'] = {'auto': finder.roi.auto}
+    if targeter is not None:
+        recipe['targeter'] = type(targeter).__name__
+        recipe['targeter_settings'] = {k: v['value'] for k, v in targeter.settings.items()}
+    return recipe
+
+
+def save_recipe(path, recipe):
+    with open(path, 'w') as f:
+        json.dump(recipe, f, indent=2)
+
+
+def load_recipe(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def module_class(modules, name):
+    """
+    Returns the class in modules called name. Raises ValueError if there is none.
+    """
+    for module in modules:
+        if module.__name__ == name:
+            return module
+    raise ValueError('unknown module %r'%(name,))
+
+
+def check_recipe(recipe):
+    """
+    Checks that a recipe, e.g. one sent by a client, names a registered finder
+    and targeter. Raises ValueError if it does not.
+    """
+    if not isinstance(recipe, dict) or 'finder' not in recipe:
+        raise ValueError('a recipe needs a finder')
+    module_class(FINDERS, recipe['finder'])
+    if 'targeter' in recipe:
+        module_class(TARGETERS, recipe['targeter'])
+
+
+def make_finder(image, recipe):
+    """
+    Makes the recipe's finder for an image, with its settings, filters and
+    ROI, without running it.
+    """
+    finder = module_class(FINDERS, recipe['finder'])(image)
+    finder.load_settings(recipe.get('finder_settings', {}))
+    if 'filters' in recipe:
+        finder.set_filters(recipe['filters'])
+    if 'roi' in recipe:
+        finder.set_roi(ROI.from_image(image, auto=recipe['roi'].get('auto', False)))
+    return finder
+
+
+def make_targeter(finder, image, recipe):
+    """
+    Makes the recipe's targeter on the grains of a finder, without running it.
+    """
+    targeter = module_class(TARGETERS, recipe['targeter'])(finder.contours(), image, finder.binary_image(),
+                                                           finder.labels(), finder.stats(), finder.centroids())
+    targeter.roi = finder.roi
+    targeter.load_settings(recipe.get('targeter_settings', {}))
+    return targeter
+
+
+def apply_recipe(image, recipe):
+    """
+    Runs the recipe's finder and targeter on an image. Returns (finder, targeter),
+    the targeter being None if the recipe has none.
+    """
+    finder = make_finder(image, recipe)
+    finder.make_binary()
+    finder.contours()
+
+    if 'targeter' not in recipe:
+        return finder, None
+
+    targeter = make_targeter(finder, image, recipe)
+    with memory.stage('targeting'):
+        targeter.compute_spots()
+
+    return finder, targeter
+
+
+def write_spots(path, coords, stage_coords):
+    """
+    Writes spots as CSV with their image and stage coordinates.
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['spot', 'x_image', 'y_image', 'x_stage', 'y_stage'])
+        for i, (c, s) in enumerate(zip(coords, stage_coords)):
+            writer.writerow([i + 1, c[0], c[1], '%.3f'%s[0], '%.3f'%s[1]])
+
+
+def spots_path(source, output_dir):
+    return os.path.join(output_dir, file_root(source) + '_spots.csv')
+
+
+def run_mount(source, recipe, time_budget=2.0, progress=None):
+    """
+    Loads a mount, runs the recipe and orders the spots for stage travel.
+    Returns (image, transform, finder, targeter, coords, stage_coords), or
+    None if the mount could not be loaded. If given, progress is called with
+    the name of each stage as it starts.
+    """
+    if progress is not None:
+        progress('loading')
+    with memory.stage('loading'):
+        loaded = load_source(source)
+    if loaded is None:
+        return None
+    image, align, transform = loaded
+
+    if progress is not None:
+        progress('targeting')
+    finder, targeter = apply_recipe(image, recipe)
+    coords = list(targeter.coords) if targeter is not None else []
+
+    stage = image_to_stage(transform, coords)
+    if len(coords) > 0:
+        if progress is not None:
+            progress('sequencing')
+        with memory.stage('sequencing'):
+            order, _, _ = order_spots(stage, time_budget)
+        coords = [coords[i] for i in order]
+        stage = stage[order]
+
+    return image, transform, finder, targeter, coords, stage
+
+
+def process_mount(source, recipe, output_dir, time_budget=2.0):
+    """
+    Runs a mount through run_mount and writes its spot file. Returns the path
+    of the spot file, or None if the mount could not be loaded.
+    """
+    result = run_mount(source, recipe, time_budget)
+    if result is None:
+        return None
+    _, _, _, _, coords, stage = result
+
+    path = spots_path(source, output_dir)
+    write_spots(path, coords, stage)
+    return path
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+def place_spots(points, grains, spot_size, max_per_grain=1, min_spacing=0):
+    """
+    Greedily places non-overlapping spots from a list of candidate points.
+
+    Candidates are considered in the order given, so the caller decides which
+    positions are preferred. A candidate is accepted if its grain (label 0 is
+    ignored) has fewer than max_per_grain spots and it is at least
+    spot_size + min_spacing away from every spot accepted so far, whatever
+    grain that spot belongs to.
+
+    Accepted spots are hashed into a grid with cells as large as the minimum
+    centre-to-centre distance, so each test only looks at the 3x3 cells around
+    the candidate and the cost stays linear in the number of candidates.
+
+    Returns the indices of the accepted candidates.
+    """
+    points = np.asarray(points).reshape(-1, 2)
+    grains = np.asarray(grains).ravel()
+
+    if len(points) == 0 or max_per_grain < 1:
+        return np.array([], dtype=np.intp)
+
+    distance = max(float(spot_size + min_spacing), 1.0)
+    distance2 = distance**2
+
+    cells = np.floor_divide(points, distance).astype(np.int64).tolist()
+    xy = points.astype(float).tolist()
+    counts = np.zeros(int(grains.max()) + 1, dtype=np.intp).tolist()
+
+    grid = {}
+    accepted = []
+
+    for i, grain in enumerate(grains.tolist()):
+        if grain <= 0 or counts[grain] >= max_per_grain:
+            continue
+
+        x, y = xy[i]
+        cx, cy = cells[i]
+        clear = True
+        for nx in (cx - 1, cx, cx + 1):
+            for ny in (cy - 1, cy, cy + 1):
+                for (px, py) in grid.get((nx, ny), ()):
+                    if (px - x)**2 + (py - y)**2 < distance2:
+                        clear = False
+                        break
+                if not clear:
+                    break
+            if not clear:
+                break
+
+        if not clear:
+            continue
+
+        grid.setdefault((cx, cy), []).append((x, y))
+        counts[grain] += 1
+        accepted.append(i)
+
+    return np.array(accepted, dtype=np.intp)
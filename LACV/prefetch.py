@@ -0,0 +1,243 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import numpy as np
+
+from .pipeline import load_source, make_finder, make_targeter
+from . import memory
+
+try:
+    from PyQt5.QtCore import QCoreApplication
+except ImportError:
+    QCoreApplication = None
+
+# Memory the mounts held by a Prefetcher may take, in bytes
+DEFAULT_BUDGET = 2*2**30
+LOW_MEMORY_BUDGET = 512*2**20
+
+
+def array_bytes(obj, seen=None):
+    """
+    The memory taken by the NumPy arrays reachable from obj through dicts,
+    lists, tuples and the attributes of LACV objects. Views count once, as
+    the array they belong to.
+    """
+    if seen is None:
+        seen = set()
+
+    if isinstance(obj, np.ndarray):
+        while isinstance(obj.base, np.ndarray):
+            obj = obj.base
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        return obj.nbytes
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, dict):
+        return sum([array_bytes(v, seen) for v in obj.values()])
+    if isinstance(obj, (list, tuple)):
+        return sum([array_bytes(v, seen) for v in obj])
+    if type(obj).__module__.split('.')[0] == __name__.split('.')[0] and hasattr(obj, '__dict__'):
+        return array_bytes(vars(obj), seen)
+    return 0
+
+
+class Mount:
+    """
+    A decoded mount, and the finder and targeter of a recipe run on it with
+    their display results already cached.
+    """
+
+    def __init__(self, source, image, align, transform, recipe=None, finder=None, targeter=None):
+        self.source = source
+        self.image = image
+        self.align = align
+        self.transform = transform
+        self.recipe = recipe
+        self.finder = finder
+        self.targeter = targeter
+
+    def nbytes(self):
+        return array_bytes([self.image, self.finder, self.targeter])
+
+
+def load_mount(source, recipe=None, mount=None):
+    """
+    Loads a mount, or reuses the image of mount, and runs the finder and
+    targeter of recipe on it through get_image so that showing them costs
+    nothing. Returns the Mount, or None if the mount could not be loaded.
+    """
+    if mount is None:
+        loaded = load_source(source)
+        if loaded is None:
+            return None
+        mount = Mount(source, *loaded)
+
+    mount = Mount(source, mount.image, mount.align, mount.transform, recipe)
+    if recipe is None or 'finder' not in recipe:
+        return mount
+
+    mount.finder = make_finder(mount.image, recipe)
+    mount.finder.get_image()
+    if 'targeter' in recipe:
+        mount.targeter = make_targeter(mount.finder, mount.image, recipe)
+        mount.targeter.get_image()
+
+    # Low memory mode scratch buffers are kept per thread and are not part of
+    # the mount, so they are not left to outgrow the budget between mounts
+    memory.clear_scratch()
+
+    # Modules made on a worker thread are handed to the GUI thread, which
+    # connects their signals to its widgets
+    app = QCoreApplication.instance() if QCoreApplication is not None else None
+    if app is not None:
+        for module in (mount.finder, mount.targeter):
+            if module is not None:
+                module.moveToThread(app.thread())
+
+    return mount
+
+
+class Prefetcher:
+    """
+    Decodes the mounts of a session around the current one in background
+    threads, so that stepping to the next or previous mount does not wait
+    for the image, its .Align file or the recipe.
+
+    The ahead mounts after the current one and the behind mounts before it
+    are kept, nearest first, as long as they fit in budget bytes. Mounts that
+    are not loaded yet are counted as large as the largest one seen so far.
+    With a recipe, its finder and targeter are run on each mount as well;
+    when the recipe changes, kept mounts are rerun from their decoded images.
+    """
+
+    def __init__(self, sources, recipe=None, ahead=2, behind=1, workers=2, budget=None):
+        self.sources = list(sources)
+        self.recipe = recipe
+        self.ahead = ahead
+        self.behind = behind
+        if budget is None:
+            budget = LOW_MEMORY_BUDGET if memory.low_memory else DEFAULT_BUDGET
+        self.budget = budget
+
+        self.index = None
+        self._futures = {}
+        self._estimate = 0
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(workers)
+
+    def set_recipe(self, recipe):
+        with self._lock:
+            self.recipe = recipe
+            if self.index is not None:
+                self._schedule()
+
+    def wanted(self, index):
+        """
+        The indices to keep around index, in the order they are loaded.
+        """
+        after = range(index + 1, min(len(self.sources), index + self.ahead + 1))
+        before = range(index - 1, max(-1, index - self.behind - 1), -1)
+        return [index] + list(after) + list(before)
+
+    def get(self, index):
+        """
+        Makes index the current mount and returns it, waiting for it if it is
+        still being loaded, or loading it on this thread if it was not
+        prefetched. Returns None if it could not be loaded.
+        """
+        with self._lock:
+            self.index = index
+            future = self._futures.get(index)
+            recipe = self.recipe
+
+        mount = None
+        if future is not None and not future.cancelled():
+            try:
+                mount = future.result()
+            except Exception as e:
+                print('Prefetching %s failed: %s'%(self.sources[index], e))
+
+        if mount is None:
+            mount = load_mount(self.sources[index], recipe)
+        elif mount.recipe != recipe:
+            mount = load_mount(self.sources[index], recipe, mount)
+
+        with self._lock:
+            if self.index == index:
+                future = Future()
+                future.set_result(mount)
+                self._futures[index] = future
+                if mount is not None:
+                    self._estimate = max(self._estimate, mount.nbytes())
+                self._schedule()
+
+        return mount
+
+    def _schedule(self):
+        """
+        Submits the wanted mounts that fit in the budget and drops the others.
+        The current mount is left alone, get reruns it if its recipe changed.
+        Mounts that failed to load are not retried until they are dropped.
+        """
+        wanted = self.wanted(self.index)
+        used = 0
+
+        for i in wanted:
+            future = self._futures.get(i)
+            mount = None
+            if future is not None and future.done() and not future.cancelled() and future.exception() is None:
+                mount = future.result()
+
+            size = mount.nbytes() if mount is not None else self._estimate
+            if i != self.index and used + size > self.budget:
+                self._drop(i)
+                continue
+            used += size
+
+            if future is None:
+                future = self._executor.submit(load_mount, self.sources[i], self.recipe)
+            elif i != self.index and mount is not None and mount.recipe != self.recipe:
+                future = self._executor.submit(load_mount, self.sources[i], self.recipe, mount)
+            else:
+                continue
+
+            self._futures[i] = future
+            future.add_done_callback(self._loaded)
+
+        for i in list(self._futures):
+            if i not in wanted:
+                self._drop(i)
+
+    def _drop(self, i):
+        future = self._futures.pop(i, None)
+        if future is not None:
+            future.cancel()
+
+    def _loaded(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        mount = future.result()
+        with self._lock:
+            if mount is not None:
+                self._estimate = max(self._estimate, mount.nbytes())
+            if self.index is not None and future in self._futures.values():
+                self._schedule()
+
+    def loaded(self):
+        """
+        Returns the indices of the mounts that are decoded and ready.
+        """
+        with self._lock:
+            return sorted([i for i, f in self._futures.items() if f.done() and not f.cancelled()])
+
+    def stop(self):
+        with self._lock:
+            for i in list(self._futures):
+                self._drop(i)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,195 @@
+import cv2
+import numpy as np
+
+# Resolution of the mount mask relative to the image
+MASK_SCALE = 0.125
+# Side of the tiles regions are made of, in image pixels
+TILE_SIZE = 256
+# Width of the border kept around grains in the automatic mask, in image pixels
+MASK_MARGIN = 32
+# Extra context given to a finder around each region so that smoothing and
+# opening behave at the region edges as they would on the full image
+REGION_PAD = 64
+
+
+def mount_mask(image, scale=MASK_SCALE, margin=MASK_MARGIN):
+    """
+    Finds the part of a mount with grains in it from a cheap low resolution
+    pass: Otsu thresholding of the downsampled image, with specks removed and
+    the rest grown by margin. Returns the mask at the reduced resolution.
+    """
+    gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, mask_size(image.shape, scale), interpolation=cv2.INTER_AREA)
+    _, mask = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+
+    grow = 2*int(np.ceil(margin*scale)) + 1
+    return cv2.dilate(mask, np.ones((grow, grow), np.uint8))
+
+
+def mask_size(shape, scale):
+    return max(1, int(np.ceil(shape[1]*scale))), max(1, int(np.ceil(shape[0]*scale)))
+
+
+def polygon_mask(shape, polygons, scale=1.0, offset=(0, 0)):
+    """
+    Rasterizes polygons given in image coordinates into a mask of the given
+    shape, which covers the image scaled by scale from offset onwards.
+    """
+    mask = np.zeros(shape[:2], dtype=np.uint8)
+    points = [np.round((np.asarray(p, dtype=np.float64) - offset)*scale).astype(np.int32) for p in polygons]
+    cv2.fillPoly(mask, points, 255)
+    return mask
+
+
+def merge_boxes(boxes):
+    """
+    Merges overlapping (x, y, w, h) rectangles until none overlap.
+    """
+    boxes = [list(b) for b in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]:
+                    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+                    x1, y1 = max(a[0] + a[2], b[0] + b[2]), max(a[1] + a[3], b[1] + b[3])
+                    boxes[i] = [x0, y0, x1 - x0, y1 - y0]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return [tuple(b) for b in boxes]
+
+
+def mask_regions(mask, scale, shape, tile_size=TILE_SIZE):
+    """
+    Covers a low resolution mask with tiles and returns the bounding
+    rectangles (x, y, w, h), in image pixels, of each connected group of
+    occupied tiles. The rectangles do not overlap.
+    """
+    cell = max(1, int(round(tile_size*scale)))
+    tile = cell/scale
+    rows, cols = -(-mask.shape[0]//cell), -(-mask.shape[1]//cell)
+
+    padded = np.zeros((rows*cell, cols*cell), dtype=bool)
+    padded[:mask.shape[0], :mask.shape[1]] = mask > 0
+    occupied = padded.reshape(rows, cell, cols, cell).any(axis=(1, 3)).astype(np.uint8)
+
+    n, _, stats, _ = cv2.connectedComponentsWithStats(occupied, connectivity=8)
+    boxes = []
+    for c, r, w, h in stats[1:, :4]:
+        x0, y0 = int(c*tile), int(r*tile)
+        x1, y1 = min(shape[1], int(np.ceil((c + w)*tile))), min(shape[0], int(np.ceil((r + h)*tile)))
+        boxes.append((x0, y0, x1 - x0, y1 - y0))
+
+    return sorted(merge_boxes(boxes), key=lambda b: (b[1], b[0]))
+
+
+class ROI:
+    """
+    The part of an image that finders and targeters process: user drawn
+    polygons, an automatic mount mask, or both. It is covered by rectangular
+    regions made of whole tiles, and the work done on an image is proportional
+    to their area rather than to the image size.
+
+    The automatic mask is coarse and only chooses the tiles; within the
+    regions finders see every pixel. Binary images are clipped to the user
+    polygons only.
+
+    Results computed on a region are pasted back at its offset, so labels,
+    contours and spots stay in full image coordinates and map to the stage
+    through the mount's usual affine transform.
+    """
+
+    def __init__(self, shape, mask, scale=MASK_SCALE, polygons=(), auto=False, tile_size=TILE_SIZE):
+        self.shape = tuple(shape[:2])
+        self.mask = mask
+        self.scale = scale
+        self.polygons = [np.asarray(p, dtype=np.float64).tolist() for p in polygons]
+        self.auto = auto
+        self.regions = mask_regions(mask, scale, self.shape, tile_size)
+
+    @classmethod
+    def from_image(cls, image, polygons=(), auto=True, scale=MASK_SCALE, tile_size=TILE_SIZE):
+        """
+        Builds the ROI of an image, or returns None if there are no polygons
+        and no automatic mask, i.e. the whole image is processed.
+        """
+        if not polygons and not auto:
+            return None
+
+        size = mask_size(image.shape, scale)
+        if auto:
+            mask = mount_mask(image, scale)
+        else:
+            mask = np.full((size[1], size[0]), 255, dtype=np.uint8)
+
+        if polygons:
+            # Grown by a pixel so that the coarse mask covers the polygon edges
+            inside = cv2.dilate(polygon_mask(mask.shape, polygons, scale), np.ones((3, 3), np.uint8))
+            mask = cv2.bitwise_and(mask, inside)
+
+        return cls(image.shape, mask, scale, polygons, auto, tile_size)
+
+    def area_fraction(self):
+        return sum([w*h for _, _, w, h in self.regions])/float(self.shape[0]*self.shape[1])
+
+    def region_mask(self, x, y, w, h):
+        """
+        Returns the mask of the user polygons over a rectangle at full
+        resolution, or None if there are none.
+        """
+        if not self.polygons:
+            return None
+        return polygon_mask((h, w), self.polygons, offset=(x, y))
+
+    def padded(self, image, pad=REGION_PAD):
+        """
+        Yields (x, y, w, h, view, inner) for the regions of an image, view
+        being the region padded by pad pixels of context and inner the
+        (row, column) slices of the region within it.
+        """
+        height, width = self.shape
+        for x, y, w, h in self.regions:
+            x0, y0 = max(0, x - pad), max(0, y - pad)
+            x1, y1 = min(width, x + w + pad), min(height, y + h + pad)
+            yield x, y, w, h, image[y0:y1, x0:x1], (slice(y - y0, y - y0 + h), slice(x - x0, x - x0 + w))
+
+    def apply(self, image, function, pad=REGION_PAD):
+        """
+        Runs function, which maps an image to a binary image of the same size,
+        on every region padded by pad pixels of context. Returns the full size
+        binary image, empty outside the regions and outside the polygons.
+        """
+        binary = np.zeros(self.shape, dtype=np.uint8)
+
+        for x, y, w, h, view, inner in self.padded(image, pad):
+            result = function(view)[inner]
+            mask = self.region_mask(x, y, w, h)
+            binary[y:y + h, x:x + w] = result if mask is None else cv2.bitwise_and(result, mask)
+
+        return binary
+
+    def histogram(self, image, function, pad=REGION_PAD):
+        """
+        The 256 bin histogram over the ROI of function, which maps an image to
+        a uint8 image of the same size, run on the padded regions like apply.
+        """
+        hist = np.zeros(256)
+        for x, y, w, h, view, inner in self.padded(image, pad):
+            result = np.ascontiguousarray(function(view)[inner])
+            hist += cv2.calcHist([result], [0], self.region_mask(x, y, w, h), [256], [0, 256]).ravel()
+
+        return hist
+
+    def views(self, image):
+        """
+        Yields (x, y, view) for the regions of an image.
+        """
+        for x, y, w, h in self.regions:
+            yield x, y, image[y:y + h, x:x + w]
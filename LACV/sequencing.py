@@ -0,0 +1,224 @@
+import time
+import math
+import numpy as np
+
+
+def path_length(points, order):
+    """
+    Returns the length of the open path visiting points in the given order.
+    """
+    p = np.asarray(points, dtype=np.float64)[order]
+    if len(p) < 2:
+        return 0.0
+    return float(np.sqrt((np.diff(p, axis=0)**2).sum(axis=1)).sum())
+
+
+class SpatialGrid:
+    """
+    A uniform grid hash of point indices, sized so that a cell holds about
+    two points on average.
+    """
+
+    def __init__(self, points):
+        self.points = np.asarray(points, dtype=np.float64)
+        n = len(self.points)
+        lo = self.points.min(axis=0)
+        hi = self.points.max(axis=0)
+        area = max((hi[0] - lo[0])*(hi[1] - lo[1]), 1.0)
+        self.cell = max(math.sqrt(2.0*area/n), 1e-9)
+        self.origin = lo
+
+        self.keys = [tuple(k) for k in np.floor((self.points - lo)/self.cell).astype(np.int64).tolist()]
+        self.cells = {}
+        for i, k in enumerate(self.keys):
+            self.cells.setdefault(k, []).append(i)
+
+    def near(self, i):
+        """
+        Returns the indices in the 3x3 cells around point i, excluding i.
+        """
+        cx, cy = self.keys[i]
+        found = []
+        for nx in (cx - 1, cx, cx + 1):
+            for ny in (cy - 1, cy, cy + 1):
+                found.extend(self.cells.get((nx, ny), ()))
+        found.remove(i)
+        return found
+
+
+def nearest_neighbour_order(points, start=0):
+    """
+    Builds a path by always moving to the closest unvisited point.
+
+    Unvisited points are kept in a SpatialGrid and searched ring by ring around
+    the current point. Once the rings become larger than what is left to visit,
+    the remaining points are searched directly.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    n = len(points)
+    if n == 0:
+        return np.array([], dtype=np.intp)
+
+    grid = SpatialGrid(points)
+    cells = {k: list(v) for k, v in grid.cells.items()}
+    xy = points.tolist()
+
+    def take(i):
+        cell = cells[grid.keys[i]]
+        cell.remove(i)
+        if not cell:
+            del cells[grid.keys[i]]
+
+    order = [start]
+    take(start)
+    current = start
+
+    for _ in range(n - 1):
+        x, y = xy[current]
+        cx, cy = grid.keys[current]
+        best = -1
+        best_d2 = float('inf')
+        r = 0
+
+        while True:
+            if 8*r > len(cells):
+                # Searching rings is now more expensive than looking at every remaining point
+                for k in cells:
+                    for j in cells[k]:
+                        d2 = (xy[j][0] - x)**2 + (xy[j][1] - y)**2
+                        if d2 < best_d2:
+                            best, best_d2 = j, d2
+                break
+
+            for nx in range(cx - r, cx + r + 1):
+                for ny in ((cy - r, cy + r) if abs(nx - cx) != r else range(cy - r, cy + r + 1)):
+                    for j in cells.get((nx, ny), ()):
+                        d2 = (xy[j][0] - x)**2 + (xy[j][1] - y)**2
+                        if d2 < best_d2:
+                            best, best_d2 = j, d2
+
+            # Anything in further rings is at least r cells away
+            if best >= 0 and best_d2 <= (r*grid.cell)**2:
+                break
+            r += 1
+
+        take(best)
+        order.append(best)
+        current = best
+
+    return np.array(order, dtype=np.intp)
+
+
+def improve_order(points, order, time_budget=1.0, grid=None):
+    """
+    Refines an open path with 2-opt and Or-opt moves until no move improves
+    it or time_budget seconds have passed. The first point stays first.
+
+    Moves are only tried between points that are close in a SpatialGrid, so a
+    sweep costs O(n) distance tests plus the cost of the accepted moves.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    order = np.array(order, dtype=np.intp)
+    n = len(order)
+    if n < 4:
+        return order
+
+    if grid is None:
+        grid = SpatialGrid(points)
+    xy = points.tolist()
+    deadline = time.perf_counter() + time_budget
+    eps = 1e-9
+
+    def d(a, b):
+        if a < 0 or b < 0:
+            return 0.0
+        return math.sqrt((xy[a][0] - xy[b][0])**2 + (xy[a][1] - xy[b][1])**2)
+
+    def rebuild_positions():
+        pos = np.empty(n, dtype=np.intp)
+        pos[order] = np.arange(n)
+        return pos
+
+    pos = rebuild_positions()
+
+    def at(k):
+        # Index of the point at path position k, -1 past the open end
+        return int(order[k]) if k < n else -1
+
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+
+        # 2-opt: replace edges (p, p+1) and (q, q+1) by (p, q) and (p+1, q+1)
+        for a in range(n):
+            if time.perf_counter() > deadline:
+                break
+            i = int(pos[a])
+            for c in grid.near(a):
+                j = int(pos[c])
+                p, q = (i, j) if i < j else (j, i)
+                if q - p < 2:
+                    continue
+                gain = d(at(p), at(p + 1)) + d(at(q), at(q + 1)) - d(at(p), at(q)) - d(at(p + 1), at(q + 1))
+                if gain > eps:
+                    order[p + 1:q + 1] = order[p + 1:q + 1][::-1].copy()
+                    pos[order[p + 1:q + 1]] = np.arange(p + 1, q + 1)
+                    improved = True
+                    i = int(pos[a])
+
+        # Or-opt: move a run of 1 to 3 points between two other neighbours
+        for length in (1, 2, 3):
+            k = 1
+            while k + length <= n:
+                if time.perf_counter() > deadline:
+                    break
+                first, last = at(k), at(k + length - 1)
+                prev, nxt = at(k - 1), at(k + length)
+                removed = d(prev, first) + d(last, nxt) - d(prev, nxt)
+
+                best_gain, best_c, best_rev = eps, -1, False
+                for c in grid.near(first):
+                    j = int(pos[c])
+                    if k - 1 <= j < k + length:
+                        continue
+                    sc = at(j + 1)
+                    base = d(c, sc)
+                    forward = d(c, first) + d(last, sc) - base
+                    backward = d(c, last) + d(first, sc) - base
+                    gain = removed - min(forward, backward)
+                    if gain > best_gain:
+                        best_gain, best_c, best_rev = gain, c, backward < forward
+
+                if best_c >= 0:
+                    segment = order[k:k + length].copy()
+                    if best_rev:
+                        segment = segment[::-1]
+                    rest = np.concatenate([order[:k], order[k + length:]])
+                    insert = int(np.nonzero(rest == best_c)[0][0]) + 1
+                    order = np.concatenate([rest[:insert], segment, rest[insert:]])
+                    pos = rebuild_positions()
+                    improved = True
+                k += 1
+
+    return order
+
+
+def order_spots(points, time_budget=1.0):
+    """
+    Orders spots to reduce the total travel of the stage moving between them.
+
+    A nearest neighbour path is refined with 2-opt and Or-opt moves under
+    time_budget seconds. Returns (order, initial_length, final_length) where
+    initial_length is the length of the path in the given order.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    initial = path_length(points, np.arange(len(points)))
+    if len(points) < 3:
+        return np.arange(len(points)), initial, initial
+
+    start = time.perf_counter()
+    order = nearest_neighbour_order(points)
+    remaining = max(time_budget - (time.perf_counter() - start), 0)
+    order = improve_order(points, order, remaining)
+
+    return order, initial, path_length(points, order)
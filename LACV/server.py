@@ -0,0 +1,542 @@
+import os
+import sys
+import json
+import time
+import heapq
+import queue
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+from .pipeline import run_mount, write_spots, spots_path, check_recipe
+
+DEFAULT_PORT = 8765
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+def run_job(job_id, source, recipe, output_dir, time_budget, events):
+    """
+    Runs one mount in a worker, reporting each stage on the events queue.
+    Returns the spot file path and spot count, or None if the mount could not
+    be loaded.
+    """
+    def progress(stage):
+        events.put((job_id, stage))
+
+    result = run_mount(source, recipe, time_budget, progress)
+    if result is None:
+        return None
+    _, _, _, _, coords, stage = result
+
+    progress('writing')
+    os.makedirs(output_dir, exist_ok=True)
+    path = spots_path(source, output_dir)
+    write_spots(path, coords, stage)
+    return {'spots': path, 'count': len(coords)}
+
+
+class Job:
+
+    def __init__(self, job_id, source, recipe, priority, output_dir):
+        self.id = job_id
+        self.source = source
+        self.recipe = recipe
+        self.priority = priority
+        self.output_dir = output_dir
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.events = []
+
+    def info(self):
+        return {
+            'id': self.id,
+            'source': self.source,
+            'priority': self.priority,
+            'state': self.state,
+            'result': self.result,
+            'error': self.error
+        }
+
+
+class JobQueue:
+    """
+    Runs mounts submitted with a recipe on a pool of workers.
+
+    Queued jobs start in order of priority (highest first, then submission
+    order) and at most workers run at once. Every job keeps a list of progress
+    events (state changes and pipeline stages) that can be waited on. Jobs run
+    in worker processes, or in threads with processes=False. If a worker
+    process dies, the jobs it took down fail and a new pool is started.
+
+    Only the max_finished most recently submitted finished jobs are kept,
+    older ones are forgotten with their events.
+    """
+
+    def __init__(self, output_dir, workers=2, max_queued=100, time_budget=2.0, processes=True,
+                 max_finished=1000):
+        self.output_dir = output_dir
+        self.workers = workers
+        self.max_queued = max_queued
+        self.time_budget = time_budget
+        self.max_finished = max_finished
+        self.processes = processes
+
+        self.jobs = {}
+        self._pending = []
+        self._running = 0
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._stop = False
+
+        if processes:
+            self._manager = multiprocessing.Manager()
+            self._events = self._manager.Queue()
+        else:
+            self._manager = None
+            self._events = queue.Queue()
+        self._executor = self._new_executor()
+
+        self._threads = [threading.Thread(target=self._dispatch, daemon=True),
+                         threading.Thread(target=self._listen, daemon=True)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, source, recipe, priority=0, output_dir=None):
+        """
+        Queues a mount. Returns the job id, or None if the queue is full.
+        """
+        with self._cond:
+            if len(self._pending) >= self.max_queued:
+                return None
+            job_id = str(next(self._ids))
+            job = Job(job_id, source, recipe, priority, output_dir or self.output_dir)
+            self.jobs[job_id] = job
+            heapq.heappush(self._pending, (-priority, int(job_id), job_id))
+            self._event(job, state=QUEUED)
+            return job_id
+
+    def cancel(self, job_id):
+        """
+        Cancels a job that has not started yet. Returns whether it was cancelled.
+        """
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None or job.state != QUEUED:
+                return False
+            self._pending = [p for p in self._pending if p[2] != job_id]
+            heapq.heapify(self._pending)
+            job.state = CANCELLED
+            self._event(job, state=CANCELLED)
+            self._prune()
+            return True
+
+    def info(self, job_id):
+        with self._cond:
+            job = self.jobs.get(job_id)
+            return job.info() if job is not None else None
+
+    def list(self):
+        with self._cond:
+            return [job.info() for job in self.jobs.values()]
+
+    def wait_events(self, job_id, start=0, timeout=None):
+        """
+        Waits until job_id has events after index start or has finished.
+        Returns (events, finished).
+        """
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return [], True
+            self._cond.wait_for(lambda: len(job.events) > start or job.state in FINISHED, timeout)
+            return list(job.events[start:]), job.state in FINISHED
+
+    def _event(self, job, **event):
+        event['job'] = job.id
+        event['time'] = time.time()
+        job.events.append(event)
+        self._cond.notify_all()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.state in FINISHED]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def _new_executor(self):
+        if self.processes:
+            return ProcessPoolExecutor(self.workers)
+        return ThreadPoolExecutor(self.workers)
+
+    def _replace_executor(self, broken):
+        """
+        Starts a new pool in place of a broken one, unless that was done already.
+        """
+        with self._cond:
+            if self._stop or self._executor is not broken:
+                return
+            self._executor = self._new_executor()
+        print('A job worker died, restarting the worker pool')
+        broken.shutdown(wait=False)
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stop or (self._pending and self._running < self.workers))
+                if self._stop:
+                    return
+                _, _, job_id = heapq.heappop(self._pending)
+                job = self.jobs[job_id]
+                job.state = RUNNING
+                self._running += 1
+                self._event(job, state=RUNNING)
+                executor = self._executor
+
+            try:
+                future = executor.submit(run_job, job.id, job.source, job.recipe, job.output_dir,
+                                         self.time_budget, self._events)
+            except Exception as e:
+                # A pool that broke since the last job finished fails the job
+                # like one that was running in it
+                future = Future()
+                future.set_exception(e)
+            future.add_done_callback(lambda f, job=job, executor=executor: self._finished(job, f, executor))
+
+    def _listen(self):
+        while True:
+            item = self._events.get()
+            if item is None:
+                return
+            job_id, stage = item
+            with self._cond:
+                job = self.jobs.get(job_id)
+                if job is not None and job.state == RUNNING:
+                    self._event(job, stage=stage)
+
+    def _finished(self, job, future, executor):
+        try:
+            result = future.result()
+            error = None if result is not None else 'could not load the image/.Align pair'
+        except BrokenExecutor as e:
+            result, error = None, 'worker died: %s'%e
+            self._replace_executor(executor)
+        except Exception as e:
+            result, error = None, str(e)
+
+        with self._cond:
+            self._running -= 1
+            job.result = result
+            job.error = error
+            job.state = DONE if error is None else FAILED
+            self._event(job, state=job.state, result=result, error=error)
+            self._prune()
+
+        if error is not None:
+            print('Job %s (%s) failed: %s'%(job.id, job.source, error))
+
+    def shutdown(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+            executor = self._executor
+        executor.shutdown()
+        self._events.put(None)
+        for t in self._threads:
+            t.join()
+        if self._manager is not None:
+            self._manager.shutdown()
+
+
+def resolve_within(base, path, name):
+    """
+    Resolves a path asked for by a client under one of the server's
+    directories, relative paths being taken from base. Raises ValueError if
+    the result is not inside base.
+    """
+    base = os.path.realpath(base)
+    resolved = os.path.realpath(os.path.join(base, path))
+    if os.path.commonpath([base, resolved]) != base:
+        raise ValueError('%s %s is outside %s'%(name, path, base))
+    return resolved
+
+
+def resolve_output_dir(base, output_dir):
+    return resolve_within(base, output_dir, 'output_dir')
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """
+    The HTTP interface of a JobQueue:
+
+        POST   /jobs              {"source", "recipe", "priority", "output_dir"} -> job
+        GET    /jobs              all jobs
+        GET    /jobs/<id>         one job
+        GET    /jobs/<id>/events  progress events as a stream of JSON lines
+        GET    /jobs/<id>/spots   the spot file (CSV, in sequence order)
+        DELETE /jobs/<id>         cancel a queued job
+
+    A source must lie within the server's data root and an output_dir within
+    its output directory, relative paths being taken from them. The recipe
+    must name finder and targeter modules that LACV offers.
+    """
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+        if not parts or parts[0] != 'jobs' or len(parts) > 3:
+            return None, None
+        job_id = parts[1] if len(parts) > 1 else None
+        if job_id is not None and job_id not in self.server.jobs.jobs:
+            return None, None
+        return job_id, parts[2] if len(parts) > 2 else None
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self._send_json({'error': 'not found'}, 404)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            source = resolve_within(self.server.data_root, request['source'], 'source')
+            recipe = request['recipe']
+            check_recipe(recipe)
+            priority = int(request.get('priority', 0))
+            output_dir = request.get('output_dir')
+            if output_dir is not None:
+                output_dir = resolve_output_dir(self.server.jobs.output_dir, output_dir)
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send_json({'error': 'bad request: %s'%e}, 400)
+
+        job_id = self.server.jobs.submit(source, recipe, priority, output_dir)
+        if job_id is None:
+            return self._send_json({'error': 'queue full'}, 503)
+        self._send_json(self.server.jobs.info(job_id), 201)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/jobs':
+            return self._send_json(self.server.jobs.list())
+
+        job_id, what = self._route()
+        if job_id is None:
+            return self._send_json({'error': 'not found'}, 404)
+
+        if what is None:
+            self._send_json(self.server.jobs.info(job_id))
+        elif what == 'events':
+            self._stream_events(job_id)
+        elif what == 'spots':
+            self._send_spots(job_id)
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def do_DELETE(self):
+        job_id, what = self._route()
+        if job_id is None or what is not None:
+            return self._send_json({'error': 'not found'}, 404)
+        if not self.server.jobs.cancel(job_id):
+            return self._send_json({'error': 'job already started'}, 409)
+        self._send_json(self.server.jobs.info(job_id))
+
+    def _stream_events(self, job_id):
+        # HTTP/1.0 style: the stream ends when the connection closes
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+
+        start = 0
+        while True:
+            events, finished = self.server.jobs.wait_events(job_id, start, timeout=30)
+            for event in events:
+                self.wfile.write(json.dumps(event).encode() + b'\n')
+            self.wfile.flush()
+            start += len(events)
+            if finished and not events:
+                break
+
+    def _send_spots(self, job_id):
+        info = self.server.jobs.info(job_id)
+        if info is None:
+            return self._send_json({'error': 'not found'}, 404)
+        if info['state'] != DONE:
+            return self._send_json({'error': 'job is %s'%info['state']}, 409)
+
+        with open(info['result']['spots'], 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class JobServer(ThreadingHTTPServer):
+    """
+    Serves a JobQueue over HTTP. It binds to localhost by default; pass
+    host='0.0.0.0' to serve other machines on the lab network. Clients can
+    only submit mounts within data_root, the current directory by default.
+    """
+
+    daemon_threads = True
+    verbose = False
+
+    def __init__(self, output_dir, host='127.0.0.1', port=DEFAULT_PORT, data_root='.', **options):
+        self.data_root = os.path.realpath(data_root)
+        self.jobs = JobQueue(output_dir, **options)
+        super().__init__((host, port), JobHandler)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.jobs.shutdown()
+
+
+class JobClient:
+    """
+    A client for a JobServer, for scripts:
+
+        client = JobClient('http://lab-pc:8765')
+        job_id = client.submit('/data/mount1.Align', load_recipe('recipe.json'))
+        client.wait(job_id)
+        csv_text = client.spots(job_id)
+    """
+
+    def __init__(self, url='http://127.0.0.1:%i'%DEFAULT_PORT):
+        self.url = url.rstrip('/')
+
+    def _request(self, method, path, data=None, raw=False):
+        body = json.dumps(data).encode() if data is not None else None
+        request = Request(self.url + path, body, method=method, headers={'Content-Type': 'application/json'})
+        try:
+            with urlopen(request) as response:
+                content = response.read()
+        except HTTPError as e:
+            raise RuntimeError('%s %s failed: %s'%(method, path, e.read().decode()))
+        return content.decode() if raw else json.loads(content)
+
+    def submit(self, source, recipe, priority=0, output_dir=None):
+        """
+        Queues a mount and returns its job id. The source path must lie within
+        the server's data root, and output_dir within its output directory.
+        """
+        data = {'source': source, 'recipe': recipe, 'priority': priority}
+        if output_dir is not None:
+            data['output_dir'] = output_dir
+        return self._request('POST', '/jobs', data)['id']
+
+    def info(self, job_id):
+        return self._request('GET', '/jobs/%s'%job_id)
+
+    def list(self):
+        return self._request('GET', '/jobs')
+
+    def cancel(self, job_id):
+        self._request('DELETE', '/jobs/%s'%job_id)
+
+    def events(self, job_id):
+        """
+        Yields the progress events of a job as they happen, until it finishes.
+        """
+        with urlopen(self.url + '/jobs/%s/events'%job_id) as response:
+            for line in response:
+                yield json.loads(line)
+
+    def wait(self, job_id):
+        for _ in self.events(job_id):
+            pass
+        return self.info(job_id)
+
+    def spots(self, job_id):
+        """
+        Returns the spot file of a finished job as CSV text.
+        """
+        return self._request('GET', '/jobs/%s/spots'%job_id, raw=True)
+
+
+class LocalJobClient(JobClient):
+    """
+    A JobClient that runs jobs in this process on a thread pool instead of
+    talking to a server, with the same interface.
+    """
+
+    def __init__(self, output_dir, workers=2, **options):
+        options.setdefault('processes', False)
+        self.jobs = JobQueue(output_dir, workers, **options)
+
+    def submit(self, source, recipe, priority=0, output_dir=None):
+        job_id = self.jobs.submit(source, recipe, priority, output_dir)
+        if job_id is None:
+            raise RuntimeError('queue full')
+        return job_id
+
+    def info(self, job_id):
+        return self.jobs.info(job_id)
+
+    def list(self):
+        return self.jobs.list()
+
+    def cancel(self, job_id):
+        if not self.jobs.cancel(job_id):
+            raise RuntimeError('job %s already started'%job_id)
+
+    def events(self, job_id):
+        start = 0
+        while True:
+            events, finished = self.jobs.wait_events(job_id, start)
+            for event in events:
+                yield event
+            start += len(events)
+            if finished and not events:
+                return
+
+    def spots(self, job_id):
+        info = self.info(job_id)
+        if info['state'] != DONE:
+            raise RuntimeError('job is %s'%info['state'])
+        with open(info['result']['spots']) as f:
+            return f.read()
+
+    def close(self):
+        self.jobs.shutdown()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('usage: python -m LACV.server OUTPUT_DIR [PORT] [WORKERS] [HOST] [DATA_ROOT]')
+        sys.exit(1)
+
+    output_dir = sys.argv[1]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PORT
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    host = sys.argv[4] if len(sys.argv) > 4 else '127.0.0.1'
+    data_root = sys.argv[5] if len(sys.argv) > 5 else '.'
+
+    server = JobServer(output_dir, host, port, data_root, workers=workers)
+    print('Serving LACV jobs on http://%s:%i for mounts in %s'%(host, port, server.data_root))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
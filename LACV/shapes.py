@@ -0,0 +1,103 @@
+import cv2
+import numpy as np
+
+from .grains import central_moments, hu_moments
+
+# Hu invariants smaller than this in magnitude are numerical noise, and are
+# compared as if they were this size
+HU_EPS = 1e-5
+
+
+def _ellipse(axes):
+    def draw(canvas):
+        cv2.ellipse(canvas, (200, 200), axes, 0, 0, 360, 1, -1)
+    return draw
+
+
+def _polygon(points):
+    def draw(canvas):
+        cv2.fillPoly(canvas, [np.int32(points) + 200], 1)
+    return draw
+
+
+# Reference shapes, several drawings per class, on a 400 x 400 canvas centred at (200, 200)
+REFERENCE_SHAPES = {
+    'ellipse': [_ellipse((120, 60)), _ellipse((120, 80)), _ellipse((150, 50)), _ellipse((150, 30))],
+    'zircon': [
+        _polygon([[0, -160], [45, -100], [45, 100], [0, 160], [-45, 100], [-45, -100]]),
+        _polygon([[0, -130], [60, -70], [60, 70], [0, 130], [-60, 70], [-60, -70]])
+    ],
+    'fragment': [
+        _polygon([[-120, -40], [70, -110], [130, 20], [10, 50], [-50, 120]]),
+        _polygon([[-100, -100], [110, -60], [40, 30], [90, 120], [-90, 60]])
+    ],
+    'bubble': [_ellipse((100, 100))],
+    'crack': [
+        _polygon([[-180, -4], [180, -6], [180, 6], [-180, 4]]), _ellipse((180, 8)),
+        _polygon([[-100, -10], [100, -10], [100, 10], [-100, 10]])
+    ]
+}
+
+_library = None
+
+
+def log_hu(hu):
+    """
+    The log10 magnitudes of Hu invariants used to compare shapes, clamped at
+    HU_EPS. Signs are left out: they only tell mirror images apart, and for
+    the many invariants that are about zero they are noise.
+    """
+    return np.log10(np.maximum(np.abs(hu), HU_EPS))
+
+
+def library():
+    """
+    Returns (names, classes, signatures): the shape class names, the class index
+    of every reference drawing and their (n, 7) Hu invariants. They are
+    computed on first use and kept.
+    """
+    global _library
+    if _library is None:
+        names = list(REFERENCE_SHAPES.keys())
+        classes = []
+        canvas = np.zeros((400, 400), dtype=np.int32)
+        hu = []
+        for i, name in enumerate(names):
+            for draw in REFERENCE_SHAPES[name]:
+                canvas[:] = 0
+                draw(canvas)
+                hu.append(hu_moments(central_moments(canvas, 2))[1])
+                classes.append(i)
+        _library = (names, np.array(classes), np.array(hu))
+
+    return _library
+
+
+def match_distances(hu, reference):
+    """
+    The distance between every row of hu and every row of reference, as an
+    (n, m) array: the sum of the differences of their clamped log invariants
+    (see log_hu). Every pair is compared on all seven invariants, so a
+    reference with vanishing invariants, like a disk, is not matched on fewer
+    of them than the others.
+    """
+    return np.abs(log_hu(hu)[:, None, :] - log_hu(reference)[None, :, :]).sum(axis=2)
+
+
+def classify(hu, rejected=()):
+    """
+    Classifies shapes from their Hu invariants against the whole library in one
+    pass. Returns (names, classes, match) where classes are indices into names
+    and match is the distance to the closest reference not in a rejected class.
+    """
+    names, ref_classes, signatures = library()
+    if len(hu) == 0:
+        return names, np.zeros(0, dtype=int), np.zeros(0)
+
+    distances = match_distances(hu, signatures)
+    classes = ref_classes[np.argmin(distances, axis=1)]
+
+    accepted = np.array([names[c] not in rejected for c in ref_classes])
+    match = distances[:, accepted].min(axis=1) if accepted.any() else np.full(len(hu), np.inf)
+
+    return names, classes, match
@@ -0,0 +1,101 @@
+"""
+Smoothing filters that pick the fastest equivalent strategy for the kernel size.
+
+Gaussian blur
+    Kernels up to GAUSSIAN_EXACT_SIZE use cv2.GaussianBlur, which runs as two
+    separable 1D passes. Larger kernels use a cascade of three box filters whose
+    widths are chosen to match the Gaussian variance. Box filters are running
+    sums, so the cost per pixel does not depend on the kernel size.
+
+Median blur
+    Kernels up to MEDIAN_EXACT_SIZE use cv2.medianBlur (sorting networks for
+    small kernels, the constant time histogram median above that). Larger
+    kernels are applied to a copy downsampled so that the kernel is about
+    MEDIAN_SMALL_SIZE pixels, and the result is scaled back up with bilinear
+    interpolation. Flat regions come out the same and edges move by less than
+    the downsampling factor, so single pixels next to edges can differ a lot.
+
+Passing exact=True always uses the OpenCV filter at full resolution.
+
+How close the fast filters come to the exact ones was measured on synthetic
+1200 x 1200 mounts of 60 random elliptical grains (grey 140-230 on 30, with
+Gaussian noise of sigma 12, seeds 0 to 3). The worst seed is listed, and
+tests/test_smoothing.py checks these bounds:
+
+    Gaussian kernel          77     101    151    201    301
+    max difference (grey)    4      4      4      5      5
+    mean difference          0.31   0.40   0.45   0.69   0.89
+
+    Median kernel            33     45     75     101
+    masks agree (grey > 100) 99.7%  99.6%  99.5%  99.3%
+
+The mean Gaussian difference grows with the kernel size as the box widths
+round further from the ideal ones. Mounts with finer grains or more noise
+than these will differ more.
+"""
+import math
+import cv2
+import numpy as np
+
+GAUSSIAN_EXACT_SIZE = 75
+MEDIAN_EXACT_SIZE = 31
+MEDIAN_SMALL_SIZE = 15
+
+
+def odd(k):
+    k = int(k)
+    return k + 1 if k % 2 == 0 else k
+
+
+def gaussian_sigma(ksize):
+    """
+    The sigma OpenCV uses for a Gaussian kernel of the given size when sigma is 0.
+    """
+    return 0.3*((ksize - 1)*0.5 - 1) + 0.8
+
+
+def box_sizes(sigma, n=3):
+    """
+    Returns n odd box widths whose cascade has the variance of a Gaussian of the
+    given sigma (W. Jarosz, "Fast image convolutions").
+    """
+    ideal = math.sqrt(12.0*sigma**2/n + 1)
+    lower = int(ideal)
+    if lower % 2 == 0:
+        lower -= 1
+    upper = lower + 2
+    m = round((12.0*sigma**2 - n*lower**2 - 4*n*lower - 3*n)/(-4*lower - 4))
+    return [lower if i < m else upper for i in range(n)]
+
+
+def gaussian_blur(image, ksize, exact=False):
+    """
+    Gaussian blur of an image with an odd kernel size ksize.
+    """
+    ksize = odd(ksize)
+    if exact or ksize <= GAUSSIAN_EXACT_SIZE:
+        return cv2.GaussianBlur(image, (ksize, ksize), 0)
+
+    # Work in float so that rounding does not accumulate between passes
+    blurred = image.astype(np.float32)
+    for w in box_sizes(gaussian_sigma(ksize)):
+        blurred = cv2.blur(blurred, (w, w), borderType=cv2.BORDER_REFLECT_101)
+
+    return np.clip(blurred + 0.5, 0, 255).astype(image.dtype)
+
+
+def median_blur(image, ksize, exact=False):
+    """
+    Median blur of an 8 bit image with an odd kernel size ksize.
+    """
+    ksize = odd(ksize)
+    if exact or ksize <= MEDIAN_EXACT_SIZE:
+        return cv2.medianBlur(image, ksize)
+
+    factor = ksize/float(MEDIAN_SMALL_SIZE)
+    height, width = image.shape[:2]
+    small_size = (max(1, int(round(width/factor))), max(1, int(round(height/factor))))
+    small = cv2.resize(image, small_size, interpolation=cv2.INTER_AREA)
+    small = cv2.medianBlur(small, odd(ksize/factor))
+
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
@@ -7,19 +7,40 @@ from PyQt5.QtCore import Qt, pyqtSignal, QObject
 
 import matplotlib.pyplot as plt
 
-class BaseTargeter(QObject):
+from .grains import label_binary, ellipse_axes
+from . import memory
+from .placement import place_spots
+from .history import SettingsHistory, HistoryMixin
+
+class BaseTargeter(QObject, HistoryMixin):
 
     coords = []
 
+    settings = {}
+
+    _axes = None
+    _axes_labels = None
+
+    # The region of interest of the finder (see LACV.roi), None for the whole image
+    roi = None
+
     changed = pyqtSignal()
+    restored = pyqtSignal()
     new_spot_size = pyqtSignal(str)
 
-    def __init__(self, contours, base_image, binary_image):
+    def __init__(self, contours, base_image, binary_image, labels=None, stats=None, centroids=None):
         QObject.__init__(self, None)
         self._contours = contours
         self._base_image = base_image
         self._binary_image = binary_image
-        self.settings = {}
+
+        if labels is None and binary_image is not None:
+            labels, stats, centroids = label_binary(binary_image)
+        self._labels = labels
+        self._stats = stats
+        self._centroids = centroids
+        self.settings = {k: dict(v) for k, v in type(self).settings.items()}
+        self.history = SettingsHistory(self.setting_values())
 
     def max_spot_size(self):
         """
@@ -46,28 +67,81 @@ class BaseTargeter(QObject):
     def set_setting(self, setting_name, setting_value):
         self.settings[setting_name]['value'] = self.settings[setting_name]['type'](setting_value)
         self.coords = []
+        self.history.push(self.setting_values())
         self.changed.emit()
 
     def get_image(self):
-        self.compute_spots()
+        results = self.history.results(self.setting_values())
+        if 'coords' not in results:
+            self.compute_spots()
+            results['coords'] = self.coords
+            results['spot_size'] = self.spot_size
+        else:
+            self.coords = results['coords']
+            self.spot_size = results['spot_size']
+            if self.settings['auto_spot']['value']:
+                self.new_spot_size.emit(str(self.spot_size))
+
         return self.image_with_spots(self._base_image, spotsize=self.spot_size)
 
+    def grain_axes(self):
+        """
+        Returns the (major, minor) axis lengths of each grain, computed once from
+        the label image moments and kept until the labels change.
+        """
+        if self._labels is None:
+            return np.zeros((0, 2))
+
+        if self._axes_labels is not self._labels:
+            self._axes = ellipse_axes(self._labels)[1:]
+            self._axes_labels = self._labels
+
+        return self._axes
+
     def calculate_auto_spot_size(self):
-        min_size = 1e10
-        for contour in self._contours:
-            try:
-                el = cv2.fitEllipse(contour)
-            except:
-                continue
-            this_min = min(el[1])
-            if this_min < min_size:
-                min_size = this_min
-        
-        min_size = round(min_size)
+        minor = self.grain_axes()[:, 1]
+        minor = minor[minor > 0]
+        if len(minor) == 0:
+            return self.settings['spot_size']['value']
+
+        min_size = round(np.percentile(minor, self.settings['spot_percentile']['value']))
         self.new_spot_size.emit(str(min_size))
 
         return min_size
 
+    def distance(self, binary):
+        """
+        Returns (distance transform, steps per pixel) of a binary image: float32
+        in pixels, or compact fixed point in low memory mode. The largest
+        distance needed is bounded by the grain bounding boxes.
+        """
+        if not memory.low_memory or self._stats is None:
+            return cv2.distanceTransform(binary, cv2.DIST_L2, 3), 1
+
+        sizes = self._stats[1:, cv2.CC_STAT_WIDTH:cv2.CC_STAT_HEIGHT + 1].min(axis=1)
+        max_distance = (sizes.max() + 1)/2.0 + 1 if len(sizes) else 1
+        return memory.compact_distance(binary, max_distance)
+
+    def binary_views(self):
+        """
+        Yields (x, y, view) for the parts of the binary image to search: the
+        regions of the ROI, or the whole image.
+        """
+        if self.roi is None:
+            yield 0, 0, self._binary_image
+        else:
+            yield from self.roi.views(self._binary_image)
+
+    def place(self, candidates, grains):
+        """
+        Packs spots from the ordered candidates according to the spots per grain
+        and minimum spacing settings.
+        """
+        accepted = place_spots(candidates, grains, self.spot_size,
+                               self.settings['spots_per_grain']['value'],
+                               self.settings['min_spacing']['value'])
+        return [tuple(p) for p in candidates[accepted].tolist()]
+
     def setup_spot_size(self):
         if self.settings['auto_spot']['value']:
             self.spot_size = self.calculate_auto_spot_size()
@@ -88,46 +162,79 @@ class CoreTargeter(BaseTargeter):
             'value': True,
             'setup': []
         },
+        'spot_percentile': {
+            'type': int,
+            'control': QSpinBox,
+            'label': 'Auto spot percentile',
+            'value': 5,
+            'setup': [lambda w: w.setRange(0, 100)]
+        },
         'spot_size': {
             'type': int,
             'control': QLineEdit,
             'label': 'Spot size',
             'value': 30,
             'setup': []
+        },
+        'spots_per_grain': {
+            'type': int,
+            'control': QSpinBox,
+            'label': 'Spots per grain',
+            'value': 1,
+            'setup': [lambda w: w.setRange(1, 100)]
+        },
+        'min_spacing': {
+            'type': int,
+            'control': QSpinBox,
+            'label': 'Minimum spacing',
+            'value': 0,
+            'setup': [lambda w: w.setRange(0, 1000)]
         }
     }
 
-    def __init__(self, contours, base_image, binary_image):        
+    def __init__(self, contours, base_image, binary_image, labels=None, stats=None, centroids=None):
         self.settings['spot_size']['setup'] = [lambda w: self.new_spot_size.connect(w.setText)]
-        BaseTargeter.__init__(self, contours, base_image, binary_image)
+        BaseTargeter.__init__(self, contours, base_image, binary_image, labels, stats, centroids)
 
     def compute_spots(self):
         self.setup_spot_size()
 
-        dist = cv2.distanceTransform(self._binary_image, cv2.DIST_L2, 3)
-        kernel = np.ones((75, 75), np.uint8)
-        distdil = cv2.dilate(dist, kernel)
-        localmax = (distdil == dist)
-        localmax = localmax * dist
-        _, localmaxb = cv2.threshold(localmax, 1, 1, cv2.THRESH_BINARY)
-        localmaxb = np.array(localmaxb).astype(np.uint8)
-        spotlocs = cv2.findNonZero(localmaxb)
-        sizelist = [dist[spot[0][1]][spot[0][0]] for spot in spotlocs]
-        sizelist = np.sort(sizelist)
-
-        grainspots = {}
-        for spot in spotlocs:
-            x = spot[0][0]
-            y = spot[0][1]
-
-            for (cntindex, cnt) in enumerate(self._contours):
-                if cntindex not in grainspots and cv2.pointPolygonTest(cnt, (x,y), True) > self.spot_size/2:
-                    grainspots[cntindex] = (x,y)
-                    break
-
-        for key in grainspots:
-            self.coords.append(grainspots[key])
-        
+        # Local maxima come first so that a grain's first spot is at its core,
+        # further spots are packed from the deepest interior points outwards.
+        # The distance transform at a spot is its distance to the grain boundary.
+        maxima, interior = [], []
+        for x0, y0, binary in self.binary_views():
+            dist, steps = self.distance(binary)
+            kernel = np.ones((75, 75), np.uint8)
+            distdil = cv2.dilate(dist, kernel, dst=memory.buffer('dilated', dist.shape, dist.dtype))
+            localmax = cv2.compare(distdil, dist, cv2.CMP_EQ, dst=memory.buffer('localmax', dist.shape, np.uint8))
+            # The dilated buffer is free again, so this mask can reuse it
+            deep = cv2.compare(dist, steps, cv2.CMP_GT, dst=memory.buffer('dilated', dist.shape, np.uint8))
+            cv2.bitwise_and(localmax, deep, dst=localmax)
+            spotlocs = cv2.findNonZero(localmax)
+            if spotlocs is not None:
+                spotlocs = spotlocs.reshape(-1, 2)
+                maxima.append((spotlocs + (x0, y0), dist[spotlocs[:, 1], spotlocs[:, 0]]/steps))
+
+            stride = max(1, self.spot_size//4)
+            ys, xs = np.nonzero(dist[::stride, ::stride] > self.spot_size/2*steps)
+            points = np.stack([xs, ys], axis=1)*stride
+            interior.append((points + (x0, y0), dist[points[:, 1], points[:, 0]]/steps))
+
+        if not maxima:
+            self.coords = []
+            return self.coords
+
+        interior_points = np.concatenate([p for p, _ in interior])
+        interior_depth = np.concatenate([d for _, d in interior])
+        order = np.argsort(-interior_depth, kind='stable')
+        candidates = np.concatenate([p for p, _ in maxima] + [interior_points[order]])
+        depth = np.concatenate([d for _, d in maxima] + [interior_depth[order]])
+
+        xs, ys = candidates[:, 0], candidates[:, 1]
+        grains = np.where(depth > self.spot_size/2, self._labels[ys, xs], 0)
+
+        self.coords = self.place(candidates, grains)
         return self.coords
         
 
@@ -142,6 +249,13 @@ class MomentsTargeter(BaseTargeter):
             'value': True,
             'setup': []
         },
+        'spot_percentile': {
+            'type': int,
+            'control': QSpinBox,
+            'label': 'Auto spot percentile',
+            'value': 5,
+            'setup': [lambda w: w.setRange(0, 100)]
+        },
         'spot_size': {
             'type': int,
             'control': QLineEdit,
@@ -151,21 +265,18 @@ class MomentsTargeter(BaseTargeter):
         }
     }
 
-    def __init__(self, contours, base_image, binary_image):        
-        BaseTargeter.__init__(self, contours, base_image, binary_image)
+    def __init__(self, contours, base_image, binary_image, labels=None, stats=None, centroids=None):
+        BaseTargeter.__init__(self, contours, base_image, binary_image, labels, stats, centroids)
 
     def compute_spots(self):
         self.setup_spot_size()
-        self.coords = []
-        if self._contours is None:
-            return
-        for c in self._contours:
-            if cv2.contourArea(c) < math.pi*(self.spot_size/2.0)**2:
-                continue
-            M = cv2.moments(c)
-            cX = int(M["m10"] / M["m00"])
-            cY = int(M["m01"] / M["m00"])    
-            self.coords.append( [cX, cY] )
+        if self._stats is None:
+            self.coords = []
+            return self.coords
+
+        areas = self._stats[1:, cv2.CC_STAT_AREA]
+        centroids = self._centroids[1:][areas >= math.pi*(self.spot_size/2.0)**2]
+        self.coords = centroids.astype(int).tolist()
 
         return self.coords
 
@@ -181,71 +292,106 @@ class RimTargeter(BaseTargeter):
             'value': False,
             'setup': []
         },
+        'spot_percentile': {
+            'type': int,
+            'control': QSpinBox,
+            'label': 'Auto spot percentile',
+            'value': 5,
+            'setup': [lambda w: w.setRange(0, 100)]
+        },
         'spot_size': {
             'type': int,
             'control': QSpinBox,
             'label': 'Spot size',
             'value': 30,
             'setup': [lambda w: w.setRange(5, 500)]
+        },
+        'spots_per_grain': {
+            'type': int,
+            'control': QSpinBox,
+            'label': 'Spots per grain',
+            'value': 1,
+            'setup': [lambda w: w.setRange(1, 100)]
+        },
+        'min_spacing': {
+            'type': int,
+            'control': QSpinBox,
+            'label': 'Minimum spacing',
+            'value': 0,
+            'setup': [lambda w: w.setRange(0, 1000)]
         }
     }
 
-    def __init__(self, contours, base_image, binary_image):        
-        BaseTargeter.__init__(self, contours, base_image, binary_image)
+    def __init__(self, contours, base_image, binary_image, labels=None, stats=None, centroids=None):
+        BaseTargeter.__init__(self, contours, base_image, binary_image, labels, stats, centroids)
 
     def compute_spots(self):
         self.setup_spot_size()
 
-        dist = cv2.distanceTransform(self._binary_image, cv2.DIST_L2, 3)
-        
         inset = 10
-        rim = cv2.inRange(dist, math.floor(self.spot_size/2.0)+inset, math.ceil(self.spot_size/2.0 + 0.5)+inset)         
-        
-        spotlocs = cv2.findNonZero(rim)
-        spotlocs = spotlocs.reshape( (spotlocs.shape[0], spotlocs.shape[2]) )
-        spotlocs = spotlocs[spotlocs[:,0].argsort()]
-
-        grainspots = {}
-        for spot in spotlocs:
-            x = spot[0]
-            y = spot[1]
-
-            for (cntindex, cnt) in enumerate(self._contours):                
-                if cntindex not in grainspots and cv2.pointPolygonTest(cnt, (x,y), False) == 1:
-                    grainspots[cntindex] = (x,y)
-                    break
-
-        for key in grainspots:
-            self.coords.append(grainspots[key])
-        
+        found = []
+        for x0, y0, binary in self.binary_views():
+            dist, steps = self.distance(binary)
+            rim = cv2.inRange(dist, (math.floor(self.spot_size/2.0)+inset)*steps,
+                              (math.ceil(self.spot_size/2.0 + 0.5)+inset)*steps,
+                              dst=memory.buffer('rim', dist.shape, np.uint8))
+            spotlocs = cv2.findNonZero(rim)
+            if spotlocs is not None:
+                found.append(spotlocs.reshape(-1, 2) + (x0, y0))
+
+        if not found:
+            self.coords = []
+            return self.coords
+        spotlocs = np.concatenate(found)
+        spotlocs = spotlocs[spotlocs[:,0].argsort(kind='stable')]
+
+        grains = self._labels[spotlocs[:, 1], spotlocs[:, 0]]
+        self.coords = self.place(spotlocs, grains)
+
         return self.coords
 
 class SimpleBlobTargeter(BaseTargeter):
 
     name = 'Simple Blobs'
 
-    def __init__(self, contours, base_image, binary_image):        
-        BaseTargeter.__init__(self, contours, base_image, binary_image)
+    settings = {
+        'auto_spot': {
+            'type': bool,
+            'control': QCheckBox,
+            'label': 'Automatic spot size',
+            'value': True,
+            'setup': []
+        },
+        'spot_percentile': {
+            'type': int,
+            'control': QSpinBox,
+            'label': 'Auto spot percentile',
+            'value': 5,
+            'setup': [lambda w: w.setRange(0, 100)]
+        },
+        'spot_size': {
+            'type': int,
+            'control': QLineEdit,
+            'label': 'Spot size',
+            'value': 30,
+            'setup': []
+        }
+    }
+
+    min_area = 1200
+    max_area = 1e6
+
+    def __init__(self, contours, base_image, binary_image, labels=None, stats=None, centroids=None):
+        BaseTargeter.__init__(self, contours, base_image, binary_image, labels, stats, centroids)
 
     def compute_spots(self):
         self.setup_spot_size()
 
-        params = cv2.SimpleBlobDetector_Params()
-        params.filterByArea = True
-        params.minArea = 1200
-        params.maxArea = 1e6
-        params.filterByCircularity = False
-        params.minCircularity = 0.5
-        params.filterByConvexity = False
-        params.minConvexity = 0.9
-        params.filterByInertia = False
-        params.minInertiaRatio = 0.7
-        params.minDistBetweenBlobs = 10
-        params.filterByColor = False
-        detector = cv2.SimpleBlobDetector_create(params)
-
-        keypoints = detector.detect(self.binary_image)
-        self.coords = [k.pt for k in keypoints]
-        return self.coords
-               
+        if self._stats is None:
+            self.coords = []
+            return self.coords
 
+        areas = self._stats[1:, cv2.CC_STAT_AREA]
+        blobs = (areas >= self.min_area) & (areas <= self.max_area)
+        self.coords = [tuple(c) for c in self._centroids[1:][blobs].tolist()]
+        return self.coords
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from .pipeline import pair_sources, process_mount, spots_path, load_recipe
+
+RECIPE_FILE = 'lacv_recipe.json'
+
+
+class SourceWatcher:
+    """
+    Watches a session directory and processes every image/.Align pair that
+    appears in it with a recipe, writing a spot file per mount.
+
+    Files count as complete once their size and modification time have not
+    changed for settle_time seconds, so pairs are not picked up while the
+    microscope is still writing them. Directory changes are waited for with
+    inotify when the inotify_simple package is installed, otherwise the
+    directory is polled every poll_interval seconds.
+    """
+
+    def __init__(self, directory, recipe, output_dir=None, workers=2, settle_time=2.0, poll_interval=1.0):
+        self.directory = directory
+        self.recipe = recipe
+        self.output_dir = output_dir or directory
+        self.workers = workers
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+
+        self.results = {}
+        self._seen = {}
+        self._submitted = set()
+        self._futures = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+
+    def ready_pairs(self):
+        """
+        Returns the (image, align) pairs whose files have settled and that have
+        not been processed yet, as a dict keyed by root name.
+        """
+        now = time.time()
+        files = os.listdir(self.directory)
+        ready = {}
+
+        for root, pair in pair_sources(files).items():
+            if root in self._submitted:
+                continue
+            if os.path.exists(spots_path(pair[1], self.output_dir)):
+                self._submitted.add(root)
+                continue
+            if all([self._settled(f, now) for f in pair]):
+                ready[root] = pair
+
+        return ready
+
+    def _settled(self, filename, now):
+        try:
+            st = os.stat(os.path.join(self.directory, filename))
+        except OSError:
+            return False
+
+        state = (st.st_size, st.st_mtime)
+        previous = self._seen.get(filename)
+        self._seen[filename] = state
+        return previous == state and now - st.st_mtime >= self.settle_time
+
+    def scan(self):
+        """
+        Queues every ready pair on the worker pool.
+        """
+        for root, (image_file, align_file) in self.ready_pairs().items():
+            self._submitted.add(root)
+            source = os.path.join(self.directory, align_file)
+            print('Queueing %s'%source)
+            future = self._executor.submit(process_mount, source, self.recipe, self.output_dir)
+            self._futures[root] = future
+            future.add_done_callback(lambda f, root=root: self._finished(root, f))
+
+    def _finished(self, root, future):
+        self._futures.pop(root, None)
+        if future.cancelled():
+            # Picked up again if the watcher is restarted
+            self._submitted.discard(root)
+            return
+        try:
+            self.results[root] = future.result()
+            print('Wrote spots for %s to %s'%(root, self.results[root]))
+        except Exception as e:
+            self.results[root] = None
+            print('Processing %s failed: %s'%(root, e))
+
+    def run(self):
+        inotify = None
+        if INotify is not None:
+            inotify = INotify()
+            inotify.add_watch(self.directory, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+
+        self._executor = ProcessPoolExecutor(self.workers)
+        try:
+            while not self._stop.is_set():
+                self.scan()
+                if inotify is not None:
+                    inotify.read(timeout=int(self.poll_interval*1000))
+                else:
+                    self._stop.wait(self.poll_interval)
+        finally:
+            # Queued mounts are dropped, the ones being processed finish in
+            # their worker processes. The futures are cancelled one by one as
+            # shutdown(cancel_futures=True) needs Python 3.9
+            for future in list(self._futures.values()):
+                future.cancel()
+            self._executor.shutdown(wait=False)
+            if inotify is not None:
+                inotify.close()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops watching, waiting at most poll_interval seconds. Mounts queued
+        but not started are not processed.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('usage: python -m LACV.watch DIRECTORY [RECIPE] [OUTPUT_DIR]')
+        sys.exit(1)
+
+    directory = sys.argv[1]
+    recipe_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(directory, RECIPE_FILE)
+    output_dir = sys.argv[3] if len(sys.argv) > 3 else None
+
+    watcher = SourceWatcher(directory, load_recipe(recipe_path), output_dir)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
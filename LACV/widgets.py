@@ -1,5 +1,5 @@
-from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot, Qt, QSize
-from PyQt5.QtGui import QImage, QPixmap, QPainter
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot, Qt, QSize, QEvent, QPointF
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QKeySequence, QPen, QColor, QPolygonF
 from PyQt5.QtWidgets import QWidget, QApplication, QLabel, QToolButton, QHBoxLayout, QVBoxLayout, QGroupBox, \
     QPushButton, QSizePolicy, QComboBox, QGridLayout, QFileDialog, QLineEdit, QCheckBox, QSlider, QSpinBox, \
     QTabBar, QTabWidget, QMainWindow, QMenuBar, QMenu, QAction, QActionGroup, qApp, QScrollArea, QScrollBar, \
@@ -10,10 +10,13 @@ import cv2
 import qtawesome as qta
 from functools import partial
 import os
+import threading
 
 from .finders import BaseFinder
 from .targeters import BaseTargeter
 from .generators import BaseGenerator
+from .export import export_mounts
+from . import memory
 
 
 class ModuleWidget(QWidget):
@@ -23,6 +26,7 @@ class ModuleWidget(QWidget):
         self._module = module
         if module:            
             self._module.changed.connect(self.update_image)
+            self._module.restored.connect(self.refresh_settings)
         
         self.setLayout(QVBoxLayout())
         self.layout().setContentsMargins(3, 3, 3, 3)
@@ -34,11 +38,27 @@ class ModuleWidget(QWidget):
         self.update_image()       
 
     def setModule(self, module):
+        """
+        Shows module, or the prompt to choose one if it is None.
+        """
+        if self._module is not None:
+            self._module.changed.disconnect(self.update_image)
+            if hasattr(self._module, 'restored'):
+                self._module.restored.disconnect(self.refresh_settings)
         self._module = module
-        self._module.changed.connect(self.update_image)
+        if self._module is not None:
+            self._module.changed.connect(self.update_image)
+            if hasattr(self._module, 'restored'):
+                self._module.restored.connect(self.refresh_settings)
+        self.refresh_settings()
+        self.update_image()        
+
+    def module(self):
+        return self._module
+
+    def refresh_settings(self):
         self.layout().itemAt(0).widget().setParent(None)
         self.layout().insertWidget(0, self.create_settings_widget())
-        self.update_image()        
 
     def create_settings_widget(self):
 
@@ -85,6 +105,9 @@ class ModuleWidget(QWidget):
             elif control_t == QSpinBox:
                 control.setValue(settings[sk]['value'])
                 control.valueChanged.connect(partial(self._module.set_setting, sk))
+            elif control_t == QLabel:
+                # Read only, filled in by its setup
+                pass
             else:
                 print('Unhandled type: %s'%(control_t))
 
@@ -93,14 +116,26 @@ class ModuleWidget(QWidget):
     def update_image(self):
         if self._module:    
             self._image_widget.setImage(self._module.get_image())
+        else:
+            self._image_widget.clearImage()
 
 
 class CVImageWidget(QWidget):
 
     image = None
 
+    # Emitted when an ROI polygon is finished or the ROI is cleared
+    roiChanged = pyqtSignal()
+    # Emitted with image coordinates for every click while picking points
+    pointPicked = pyqtSignal(float, float)
+
     def __init__(self, parent=None):
         QWidget.__init__(self, parent)
+
+        # Finished ROI polygons and the one being drawn, in image coordinates
+        self.polygons = []
+        self.currentPolygon = None
+        self.picking = False
         
         self.setLayout(QVBoxLayout())
         self.layout().setContentsMargins(0, 0, 0, 0)
@@ -114,6 +149,7 @@ class CVImageWidget(QWidget):
         
         self.scrollArea.setWidget(self.imageLabel)        
         self.layout().addWidget(self.scrollArea)
+        self.imageLabel.installEventFilter(self)
 
         self.setFocusPolicy(Qt.ClickFocus)
         self.setFocus(Qt.MouseFocusReason)
@@ -133,11 +169,91 @@ class CVImageWidget(QWidget):
         
         self.image = QImage(cvimage.data, width, height, bytesPerLine, img_format)
         self.scaleFactor = 1
-        self.imageLabel.setPixmap(QPixmap.fromImage(self.image))
+        self.updatePixmap()
         self.scrollArea.setVisible(True)        
         self.imageLabel.adjustSize()
         self.update()
 
+    def clearImage(self):
+        self.image = None
+        self.imageLabel.clear()
+        self.scrollArea.setVisible(False)
+
+    def updatePixmap(self):
+        """
+        Shows the image with the ROI polygons drawn over it.
+        """
+        pixmap = QPixmap.fromImage(self.image)
+        polygons = self.polygons + ([self.currentPolygon] if self.currentPolygon else [])
+        if polygons:
+            painter = QPainter(pixmap)
+            painter.setPen(QPen(QColor(255, 160, 0), max(2, self.image.width()//500)))
+            for p in polygons:
+                qpolygon = QPolygonF([QPointF(x, y) for x, y in p])
+                if p is self.currentPolygon:
+                    painter.drawPolyline(qpolygon)
+                else:
+                    painter.drawPolygon(qpolygon)
+            painter.end()
+        self.imageLabel.setPixmap(pixmap)
+
+    def startPolygon(self):
+        """
+        Starts drawing an ROI polygon: click to add vertices, double click to
+        finish and Escape to abandon it.
+        """
+        self.currentPolygon = []
+        self.imageLabel.setCursor(Qt.CrossCursor)
+
+    def finishPolygon(self):
+        if self.currentPolygon is not None and len(self.currentPolygon) >= 3:
+            self.polygons.append(self.currentPolygon)
+            self.roiChanged.emit()
+        self.currentPolygon = None
+        self.imageLabel.unsetCursor()
+        self.updatePixmap()
+
+    def clearRoi(self):
+        self.polygons = []
+        self.currentPolygon = None
+        self.imageLabel.unsetCursor()
+        if self.image is not None:
+            self.updatePixmap()
+        self.roiChanged.emit()
+
+    def startPicking(self):
+        """
+        Emits pointPicked for every click until a double click or Escape.
+        """
+        self.picking = True
+        self.imageLabel.setCursor(Qt.PointingHandCursor)
+
+    def stopPicking(self):
+        self.picking = False
+        self.imageLabel.unsetCursor()
+
+    def eventFilter(self, obj, event):
+        if obj is self.imageLabel and self.picking:
+            if event.type() == QEvent.MouseButtonPress and event.button() == Qt.LeftButton:
+                self.pointPicked.emit(event.pos().x()/self.scaleFactor, event.pos().y()/self.scaleFactor)
+                return True
+            elif event.type() == QEvent.MouseButtonDblClick:
+                self.stopPicking()
+                return True
+
+        if obj is not self.imageLabel or self.currentPolygon is None:
+            return False
+
+        if event.type() == QEvent.MouseButtonPress and event.button() == Qt.LeftButton:
+            self.currentPolygon.append((event.pos().x()/self.scaleFactor, event.pos().y()/self.scaleFactor))
+            self.updatePixmap()
+            return True
+        elif event.type() == QEvent.MouseButtonDblClick:
+            self.finishPolygon()
+            return True
+
+        return False
+
     def scaleImage(self, factor):
         print('scaleFactor = %f'%self.scaleFactor)
         if (self.scaleFactor > 3 and factor > 1) or (self.scaleFactor < 0.1 and factor < 1):
@@ -153,7 +269,13 @@ class CVImageWidget(QWidget):
         scrollbar.setValue(int(factor * scrollbar.value() + ((factor - 1)* scrollbar.pageStep()/2)))
 
     def keyPressEvent(self, event):
-        if event.key() == Qt.Key_Equal and event.modifiers() == Qt.ControlModifier:
+        if event.key() == Qt.Key_Escape and self.picking:
+            self.stopPicking()
+        elif event.key() == Qt.Key_Escape and self.currentPolygon is not None:
+            self.currentPolygon = None
+            self.imageLabel.unsetCursor()
+            self.updatePixmap()
+        elif event.key() == Qt.Key_Equal and event.modifiers() == Qt.ControlModifier:
             self.scaleImage(1.2)
         elif event.key() == Qt.Key_Minus and event.modifiers() == Qt.ControlModifier:
             self.scaleImage(0.8)
@@ -178,6 +300,22 @@ class CVImageWidget(QWidget):
         save_action.triggered.connect(self.saveImage)
         menu.addAction(save_action)
 
+        if self.receivers(self.roiChanged) > 0:
+            menu.addSeparator()
+
+            polygon_action = QAction('Draw ROI polygon', self)
+            polygon_action.triggered.connect(self.startPolygon)
+            menu.addAction(polygon_action)
+
+            clear_action = QAction('Clear ROI', self)
+            clear_action.triggered.connect(self.clearRoi)
+            menu.addAction(clear_action)
+
+        if self.receivers(self.pointPicked) > 0:
+            pick_action = QAction('Pick colour samples', self)
+            pick_action.triggered.connect(self.startPicking)
+            menu.addAction(pick_action)
+
         menu.exec(self.mapToGlobal(event.pos()))
 
     def normalSize(self):
@@ -212,6 +350,8 @@ class LACVWindow(QMainWindow):
         self.setWindowTitle("LACV")
     
         self.sourceWidget = CVImageWidget(self)        
+        self.sourceWidget.roiChanged.connect(lambda: self.lacv.set_roi(list(self.sourceWidget.polygons)))
+        self.sourceWidget.pointPicked.connect(self.addColorSample)
         self.findWidget = ModuleWidget(parent=self)
         self.targetWidget = ModuleWidget(parent=self)
         self.generateWidget = ModuleWidget(parent=self)
@@ -220,6 +360,9 @@ class LACVWindow(QMainWindow):
         tabWidget.addTab(self.findWidget, qta.icon('fa.search'), "Find")
         tabWidget.addTab(self.targetWidget, qta.icon('fa.crosshairs'), "Target")
         tabWidget.addTab(self.generateWidget, qta.icon('fa.upload'), "Generate")
+        self.tabWidget = tabWidget
+        # Spots may have changed since the sequence was made
+        tabWidget.currentChanged.connect(lambda i: self.updateSequence() if tabWidget.widget(i) is self.generateWidget else None)
 
         self.createMenus()
 
@@ -235,10 +378,52 @@ class LACVWindow(QMainWindow):
         open_action.triggered.connect(self.openSource)
         file_menu.addAction(open_action)
 
+        previous_action = QAction('Previous mount', self)
+        previous_action.setShortcut(QKeySequence('Ctrl+PgUp'))
+        previous_action.triggered.connect(partial(self.stepMount, -1))
+        file_menu.addAction(previous_action)
+
+        next_action = QAction('Next mount', self)
+        next_action.setShortcut(QKeySequence('Ctrl+PgDown'))
+        next_action.triggered.connect(partial(self.stepMount, 1))
+        file_menu.addAction(next_action)
+
+        watch_action = QAction('Watch folder...', self)
+        watch_action.triggered.connect(self.watchFolder)
+        file_menu.addAction(watch_action)
+
+        export_action = QAction('Export annotated images...', self)
+        export_action.triggered.connect(self.exportAnnotated)
+        file_menu.addAction(export_action)
+
+        low_memory_action = QAction('Low memory mode', self)
+        low_memory_action.setCheckable(True)
+        low_memory_action.setChecked(memory.low_memory)
+        low_memory_action.toggled.connect(memory.set_low_memory)
+        file_menu.addAction(low_memory_action)
+
         quit_action = QAction('Quit', self)
         quit_action.triggered.connect(qApp.quit)
         file_menu.addAction(quit_action)
 
+        # Edit menu, acting on the finder or targeter of the current tab
+        edit_menu = self.menuBar().addMenu('Edit')
+
+        undo_action = QAction('Undo settings', self)
+        undo_action.setShortcut(QKeySequence.Undo)
+        undo_action.triggered.connect(partial(self.historyAction, 'undo'))
+        edit_menu.addAction(undo_action)
+
+        redo_action = QAction('Redo settings', self)
+        redo_action.setShortcut(QKeySequence.Redo)
+        redo_action.triggered.connect(partial(self.historyAction, 'redo'))
+        edit_menu.addAction(redo_action)
+
+        toggle_action = QAction('Compare with previous settings', self)
+        toggle_action.setShortcut(QKeySequence('Ctrl+B'))
+        toggle_action.triggered.connect(partial(self.historyAction, 'toggle'))
+        edit_menu.addAction(toggle_action)
+
         modules_dict = {
             'Finder': self.lacv.finders, 
             'Targeter': self.lacv.targeters,
@@ -262,6 +447,16 @@ class LACVWindow(QMainWindow):
         finder_settings_action = QAction('Global settings', self)
         finder_settings_action.triggered.connect(self.showFinderSettings)
         finder_menu.addAction(finder_settings_action)
+
+        clear_samples_action = QAction('Clear colour samples', self)
+        clear_samples_action.triggered.connect(self.clearColorSamples)
+        finder_menu.addAction(clear_samples_action)
+
+        auto_roi_action = QAction('Automatic mount mask', self)
+        auto_roi_action.setCheckable(True)
+        auto_roi_action.setChecked(self.lacv.auto_roi)
+        auto_roi_action.toggled.connect(lambda checked: self.lacv.set_roi(auto=checked))
+        finder_menu.addAction(auto_roi_action)
                 
 
     def showFinderSettings(self):
@@ -278,7 +473,7 @@ class LACVWindow(QMainWindow):
         l.addWidget(QLabel('Maximum'), 0, 3, Qt.AlignHCenter)
 
         orig = self.lacv.global_finder_settings 
-        d = orig.copy()
+        d = {k: dict(v) for k, v in orig.items()}
 
         def store_setting(name, param, value):
             d[name][param] = value
@@ -308,20 +503,112 @@ class LACVWindow(QMainWindow):
 
         if s.exec() == QDialog.Accepted:
             self.lacv.global_finder_settings = d
-            self.lacv.finder.changed.emit()
+            if self.lacv.finder is not None:
+                self.lacv.finder.set_filters(d)
+                self.lacv.finder.changed.emit()
             
 
     def setModule(self, m):
         if issubclass(m, BaseFinder):
             self.lacv.finder = m(self.lacv.source_image())
+            self.lacv.finder.set_filters(self.lacv.global_finder_settings)
+            self.lacv.finder.set_roi(self.lacv.roi())
             self.findWidget.setModule(self.lacv.finder)
         elif issubclass(m, BaseTargeter):
-            self.lacv.targeter = m(self.lacv.finder.contours(), self.lacv.source_image(), self.lacv.finder.binary_image())
+            finder = self.lacv.finder
+            self.lacv.targeter = m(finder.contours(), self.lacv.source_image(), finder.binary_image(),
+                                   finder.labels(), finder.stats(), finder.centroids())
+            self.lacv.targeter.roi = finder.roi
             self.targetWidget.setModule(self.lacv.targeter)
         elif issubclass(m, BaseGenerator):
             self.lacv.generator = m()
+            self.updateSequence()
             self.generateWidget.setModule(self.lacv.generator)
 
+    def updateSequence(self):
+        """
+        Orders the current spots for stage travel and hands them to the generator.
+        """
+        if self.lacv.generator is None:
+            return
+
+        coords = self.lacv.targeter.coords if self.lacv.targeter is not None else []
+        self.lacv.sequence, _ = self.lacv.sequence_spots(coords)
+        self.lacv.generator.set_sequence(self.lacv.source_image(), self.lacv.sequence)
+
+
+    def addColorSample(self, x, y):
+        if not hasattr(self.lacv.finder, 'add_sample'):
+            print('Choose the colour classification finder before picking samples')
+            return
+
+        self.lacv.finder.add_sample(x, y)
+        self.findWidget.refresh_settings()
+
+    def clearColorSamples(self):
+        if hasattr(self.lacv.finder, 'clear_samples'):
+            self.lacv.finder.clear_samples()
+            self.findWidget.refresh_settings()
+
+    def historyAction(self, action):
+        widget = self.tabWidget.currentWidget()
+        module = widget.module() if isinstance(widget, ModuleWidget) else None
+        if module is None or not hasattr(module, 'history'):
+            return
+
+        getattr(module, action)()
+
+    def watchFolder(self):
+        if self.lacv.finder is None or self.lacv.targeter is None:
+            print('Choose a finder and targeter before watching a folder')
+            return
+
+        directory = QFileDialog.getExistingDirectory(self, 'Session folder to watch')
+        if len(directory) < 1:
+            print("No folder selected")
+            return
+
+        if self.lacv.watcher is not None:
+            self.lacv.watcher.stop()
+        self.lacv.watch(directory)
+
+    def exportAnnotated(self):
+        if self.lacv.finder is None or self.lacv.targeter is None:
+            print('Choose a finder and targeter before exporting')
+            return
+
+        sources, _ = QFileDialog.getOpenFileNames(
+            filter="Align files (*.Align);;Image files (*.bmp;*.jpg;*.png;*.tiff)")
+        if len(sources) < 1:
+            print("No files selected")
+            return
+
+        output_dir = QFileDialog.getExistingDirectory(self, 'Export to')
+        if len(output_dir) < 1:
+            print("No folder selected")
+            return
+
+        # Rendering happens in worker processes, this thread only waits for them
+        recipe = self.lacv.recipe()
+        threading.Thread(target=export_mounts, args=(sources, recipe, output_dir), daemon=True).start()
+
+    def stepMount(self, offset):
+        if self.lacv.step_mount(offset) is not None:
+            self.showMount()
+
+    def showMount(self):
+        """
+        Shows the current mount, with the finder and targeter results the
+        controller has for it.
+        """
+        self.sourceWidget.polygons = []
+        self.sourceWidget.setImage(self.lacv.source_image())
+        self.setWindowTitle('LACV - %s'%os.path.basename(self.lacv.session[self.lacv.session_index]))
+
+        if self.lacv.finder is not None:
+            self.findWidget.setModule(self.lacv.finder)
+            # None when the recipe has no targeter, which clears the old one
+            self.targetWidget.setModule(self.lacv.targeter)
 
     def openSource(self):
         sourcePath, _ = QFileDialog.getOpenFileName(
@@ -331,13 +618,12 @@ class LACVWindow(QMainWindow):
             print("No file selected")
             return
 
-        self.lacv.set_source(sourcePath)
-        if self.lacv.source_image is None:
+        if self.lacv.open_session(sourcePath) is None:
             print("There was no source image. ======")
             return
 
-        self.sourceWidget.setImage(self.lacv.source_image())
-        
+        self.showMount()
+
         hist = cv2.calcHist([self.lacv.source_image()], [0], None, [256], [0, 256])
         plt.plot(hist)
         plt.xlim([0, 256])
@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+import pytest
+
+from LACV import shapes
+from LACV.grains import central_moments, hu_moments
+
+CANVAS = 600
+
+
+def render(draw, angle=0, scale=1.0):
+    """
+    Draws a reference shape centred on a larger canvas, rotated and scaled.
+    """
+    canvas = np.zeros((400, 400), dtype=np.int32)
+    draw(canvas)
+    image = np.zeros((CANVAS, CANVAS), dtype=np.uint8)
+    image[100:500, 100:500] = canvas.astype(np.uint8)
+    transform = cv2.getRotationMatrix2D((CANVAS/2, CANVAS/2), angle, scale)
+    return cv2.warpAffine(image, transform, (CANVAS, CANVAS), flags=cv2.INTER_NEAREST).astype(np.int32)
+
+
+def classify(mask):
+    hu = hu_moments(central_moments(mask, 2))[1:]
+    names, classes, _ = shapes.classify(hu)
+    return names[classes[0]]
+
+
+REFERENCES = [(name, i) for name, drawings in shapes.REFERENCE_SHAPES.items() for i in range(len(drawings))]
+
+
+@pytest.mark.parametrize('name,i', REFERENCES)
+@pytest.mark.parametrize('angle,scale', [(0, 1.0), (30, 1.0), (75, 1.2), (140, 0.6)])
+def test_reference_shapes_classify_as_their_class(name, i, angle, scale):
+    mask = render(shapes.REFERENCE_SHAPES[name][i], angle, scale)
+    assert classify(mask) == name
+
+
+@pytest.mark.parametrize('name,draw', [
+    ('ellipse', lambda c: cv2.ellipse(c, (200, 200), (150, 30), 0, 0, 360, 1, -1)),
+    ('crack', lambda c: cv2.rectangle(c, (100, 190), (300, 210), 1, -1)),
+    ('crack', lambda c: cv2.ellipse(c, (200, 200), (160, 20), 0, 0, 360, 1, -1)),
+    ('zircon', lambda c: cv2.fillPoly(c, [np.int32([[0, -180], [45, -140], [45, 140], [0, 180],
+                                                     [-45, 140], [-45, -140]]) + 200], 1)),
+])
+@pytest.mark.parametrize('angle', [0, 50])
+def test_elongated_shapes(name, draw, angle):
+    assert classify(render(draw, angle)) == name
+
+
+def test_disk_does_not_attract_elongated_shapes():
+    masks = [render(shapes.REFERENCE_SHAPES['bubble'][0]),
+             render(lambda c: cv2.ellipse(c, (200, 200), (150, 30), 0, 0, 360, 1, -1)),
+             render(lambda c: cv2.ellipse(c, (200, 200), (160, 20), 0, 0, 360, 1, -1))]
+    assert [classify(mask) == 'bubble' for mask in masks] == [True, False, False]
@@ -0,0 +1,49 @@
+import cv2
+import numpy as np
+import pytest
+
+from LACV.smoothing import gaussian_blur, median_blur
+
+# The test set the bounds in the LACV.smoothing docstring were measured on
+SEEDS = [0, 1, 2, 3]
+
+
+def mount(seed, size=1200, grains=60, noise=12):
+    """
+    A synthetic mount of bright elliptical grains on a dark background.
+    """
+    rng = np.random.RandomState(seed)
+    image = np.full((size, size), 30, dtype=np.float32)
+    for _ in range(grains):
+        centre = tuple(int(v) for v in rng.randint(0, size, 2))
+        axes = tuple(int(v) for v in rng.randint(15, 80, 2))
+        cv2.ellipse(image, centre, axes, float(rng.uniform(0, 180)), 0, 360, float(rng.uniform(140, 230)), -1)
+    image += rng.normal(0, noise, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+@pytest.fixture(scope='module', params=SEEDS)
+def image(request):
+    return mount(request.param)
+
+
+@pytest.mark.parametrize('ksize,max_difference,mean_difference', [
+    (77, 4, 0.31), (101, 4, 0.40), (151, 4, 0.45), (201, 5, 0.69), (301, 5, 0.89)])
+def test_box_cascade_is_close_to_gaussian_blur(image, ksize, max_difference, mean_difference):
+    difference = np.abs(gaussian_blur(image, ksize).astype(int) - gaussian_blur(image, ksize, exact=True).astype(int))
+    assert difference.max() <= max_difference
+    assert difference.mean() <= mean_difference
+
+
+@pytest.mark.parametrize('ksize,agreement', [(33, 0.997), (45, 0.996), (75, 0.995), (101, 0.993)])
+def test_downsampled_median_gives_the_same_grain_masks(image, ksize, agreement):
+    fast = median_blur(image, ksize) > 100
+    exact = median_blur(image, ksize, exact=True) > 100
+    assert (fast == exact).mean() >= agreement
+
+
+@pytest.mark.parametrize('ksize', [3, 31, 75])
+def test_small_kernels_are_exact(image, ksize):
+    assert np.array_equal(gaussian_blur(image, ksize), cv2.GaussianBlur(image, (ksize, ksize), 0))
+    if ksize <= 31:
+        assert np.array_equal(median_blur(image, ksize), cv2.medianBlur(image, ksize))